@@ -0,0 +1,690 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import ast
+import functools
+import hashlib
+import inspect
+import io
+import json
+import keyword
+import logging
+import marshal
+import os
+import pickle
+import sqlite3
+import tempfile
+import warnings
+import zlib
+from importlib.util import MAGIC_NUMBER
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
+
+from fissix import __version__ as fissix_version
+from fissix.patcomp import PatternCompiler
+from fissix.pgen2 import token, tokenize
+from fissix.pgen2.grammar import Grammar
+from fissix.pytree import Leaf, Node
+
+from .codegen import Matcher, generate_matcher
+from .types import LN, Filename, Hunk
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or "~/.cache").expanduser() / "bowler"
+
+
+def describe(obj: Any, seen: Optional[Set[int]] = None) -> str:
+    """Describe a callback by its source code and captured state.
+
+    Functions are described by their source, default arguments, and closure
+    values, recursively, so that queries built from the same helpers with
+    different arguments (eg, `.rename("a")` vs `.rename("b")`) differ.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return "<recursive>"
+    seen.add(id(obj))
+
+    if isinstance(obj, functools.partial):
+        args = [describe(arg, seen) for arg in obj.args]
+        kwargs = [f"{k}={describe(v, seen)}" for k, v in sorted(obj.keywords.items())]
+        return f"partial({describe(obj.func, seen)}, {args}, {kwargs})"
+
+    if inspect.ismethod(obj):
+        return f"method({describe(obj.__func__, seen)}, {describe(obj.__self__, seen)})"
+
+    if inspect.isfunction(obj) or inspect.isclass(obj):
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = f"{obj.__module__}.{obj.__qualname__}"
+        if inspect.isclass(obj):
+            return source
+
+        parts = [source]
+        for value in obj.__defaults__ or ():
+            parts.append(describe(value, seen))
+        for cell in obj.__closure__ or ():
+            try:
+                parts.append(describe(cell.cell_contents, seen))
+            except ValueError:  # empty cell
+                parts.append("<empty>")
+        return "\n".join(parts)
+
+    if isinstance(obj, (list, tuple)):
+        return repr(type(obj)(describe(item, seen) for item in obj))
+
+    if isinstance(obj, dict):
+        return repr(sorted((repr(k), describe(v, seen)) for k, v in obj.items()))
+
+    if type(obj).__repr__ is object.__repr__:
+        # the default repr includes the object's address, which changes between
+        # processes; describe sentinels and the like by their type instead
+        cls = type(obj)
+        description = f"<{cls.__module__}.{cls.__qualname__} object>"
+        if hasattr(obj, "__dict__"):
+            description += describe(vars(obj), seen)
+        return description
+
+    return repr(obj)
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Write a file so that concurrent readers see either all of it or none."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def encode_tree(node: LN) -> Any:
+    """Flatten a tree into nested tuples that marshal can store."""
+    if isinstance(node, Leaf):
+        return (node.type, node.value, node.prefix, node.lineno, node.column)
+    return (node.type, tuple(encode_tree(child) for child in node.children))
+
+
+def decode_tree(data: Any) -> LN:
+    if len(data) == 5:
+        type, value, prefix, lineno, column = data
+        return Leaf(type, value, context=(prefix, (lineno, column)))
+    type, children = data
+    return Node(type, [decode_tree(child) for child in children])
+
+
+class ParseCache:
+    """Parsed trees stored on disk, keyed by source text, grammar, and version.
+
+    Entries are compressed, and the least recently used ones are evicted once
+    the cache grows past `max_size` bytes.  Safe to share between processes:
+    entries are written atomically, and unreadable entries count as misses.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self, path: Union[str, Path, None] = None, max_size: int = 512 * 1024 * 1024
+    ) -> None:
+        self.path = Path(path).expanduser() if path else CACHE_DIR / "trees"
+        self.max_size = max_size
+
+    def key(self, source: str, grammar: Grammar) -> str:
+        digest = hashlib.sha256()
+        digest.update(f"{self.VERSION}:{fissix_version}:".encode())
+        digest.update(" ".join(sorted(grammar.keywords)).encode())
+        digest.update(b"\0")
+        digest.update(source.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    def get(self, key: str) -> Optional[LN]:
+        path = self.entry(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            tree = decode_tree(marshal.loads(zlib.decompress(data)))
+            # the parser records every NAME token; fixers use it to pick new names
+            tree.used_names = {
+                leaf.value for leaf in tree.leaves() if leaf.type == token.NAME
+            }
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.debug(f"discarding unreadable cache entry {path}: {e}")
+            return None
+
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return tree
+
+    def put(self, key: str, tree: LN) -> None:
+        path = self.entry(key)
+        try:
+            data = zlib.compress(marshal.dumps(encode_tree(tree)), 1)
+        except (RecursionError, ValueError) as e:
+            log.debug(f"not caching tree for {key}: {e}")
+            return
+
+        try:
+            write_atomic(path, data)
+        except OSError as e:
+            log.debug(f"failed to write cache entry {path}: {e}")
+
+    def evict(self) -> int:
+        """Remove least recently used entries until the cache fits `max_size`,
+        returning the number of entries removed."""
+        entries = []
+        total = 0
+        for path in self.path.glob("*/*"):
+            if path.name.startswith(".tmp"):
+                continue  # being written by another process
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+class ResultCache:
+    """Hunks generated by one query, keyed by filename and file contents.
+
+    Files whose contents are unchanged since the last run of the same query
+    (identified by `fingerprint`) can replay their cached hunks instead of being
+    parsed and refactored again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fingerprint: str, path: Union[str, Path, None] = None) -> None:
+        root = Path(path).expanduser() if path else CACHE_DIR / "results"
+        self.path = root / f"{fingerprint}.json"
+        self.records: Dict[Filename, Tuple[str, List[Hunk]]] = {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data["version"] == self.VERSION:
+                self.records = {k: (v[0], v[1]) for k, v in data["files"].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug(f"discarding unreadable result cache {self.path}: {e}")
+
+    @staticmethod
+    def digest(filename: Filename) -> Optional[str]:
+        try:
+            with open(filename, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def get(self, filename: Filename, digest: Optional[str]) -> Optional[List[Hunk]]:
+        record = self.records.get(filename)
+        if digest is None or record is None or record[0] != digest:
+            return None
+        return record[1]
+
+    def update(self, records: Dict[Filename, Tuple[str, List[Hunk]]]) -> None:
+        """Record results from the latest run, and forget files that are gone."""
+        self.records.update(records)
+        for filename in list(self.records):
+            if not os.path.exists(filename):
+                del self.records[filename]
+
+    def save(self) -> None:
+        data = {"version": self.VERSION, "files": self.records}
+        try:
+            write_atomic(self.path, json.dumps(data).encode())
+        except OSError as e:
+            log.debug(f"failed to write result cache {self.path}: {e}")
+
+
+def python_files(
+    paths: List[str], filename_matcher: Optional[Callable[[str], bool]] = None
+) -> Iterator[str]:
+    """Files named in `paths`, and Python files in directories under them,
+    skipping hidden files and directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                filename = os.path.join(dirpath, name)
+                if name.startswith("."):
+                    continue
+                if filename_matcher is None:
+                    if not name.endswith(".py"):
+                        continue
+                elif not filename_matcher(filename):
+                    continue
+                yield filename
+
+
+def source_imports(data: bytes) -> Optional[List[str]]:
+    """Absolute names of the modules a module's source imports, or None if
+    CPython's parser can't parse it.  `from a import b` counts as importing
+    both `a` and `a.b`, since `b` may be a submodule; relative imports are left
+    out."""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(data)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+
+    modules: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            modules.add(node.module)
+            modules.update(
+                f"{node.module}.{alias.name}"
+                for alias in node.names
+                if alias.name != "*"
+            )
+    return sorted(modules)
+
+
+class ImportIndex:
+    """Modules imported by each file, kept up to date by file size and mtime.
+
+    Files are only parsed again when they change, so `update()` on a large tree
+    that has barely changed mostly costs a `stat()` per file.  Files CPython
+    can't parse are recorded as importing anything.  Call `save()` to store the
+    index, by default in `~/.cache/bowler/imports.json`.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Union[str, Path, None] = None) -> None:
+        self.path = Path(path).expanduser() if path else CACHE_DIR / "imports.json"
+        self.records: Dict[str, Tuple[int, int, Optional[List[str]]]] = {}
+        self.refreshed = 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data["version"] == self.VERSION:
+                self.records = {k: (v[0], v[1], v[2]) for k, v in data["files"].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug(f"discarding unreadable import index {self.path}: {e}")
+
+    def imports(self, filename: str) -> Optional[List[str]]:
+        """Modules imported by a file, or None if they aren't known."""
+        filename = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        record = self.records.get(filename)
+        if record is not None and record[:2] == (stat.st_mtime_ns, stat.st_size):
+            return record[2]
+
+        try:
+            with open(filename, "rb") as f:
+                modules = source_imports(f.read())
+        except OSError:
+            return None
+        self.records[filename] = (stat.st_mtime_ns, stat.st_size, modules)
+        self.refreshed += 1
+        return modules
+
+    def might_import(self, filename: str, modules: List[str]) -> bool:
+        """Whether a file imports any of the given modules, one of their
+        submodules, or one of their parent packages."""
+        imported = self.imports(filename)
+        if imported is None:
+            return True
+        for module in modules:
+            for name in imported:
+                if (
+                    name == module
+                    or name.startswith(module + ".")
+                    or module.startswith(name + ".")
+                ):
+                    return True
+        return False
+
+    def update(
+        self, paths: List[str], filename_matcher: Optional[Callable[[str], bool]] = None
+    ) -> int:
+        """Index every Python file under the given paths, and forget files that
+        no longer exist, returning the number of files parsed."""
+        refreshed = self.refreshed
+        for filename in python_files(paths, filename_matcher):
+            self.imports(filename)
+        for filename in list(self.records):
+            if not os.path.exists(filename):
+                del self.records[filename]
+        return self.refreshed - refreshed
+
+    def save(self) -> None:
+        data = {"version": self.VERSION, "files": self.records}
+        try:
+            write_atomic(self.path, json.dumps(data).encode())
+        except OSError as e:
+            log.debug(f"failed to write import index {self.path}: {e}")
+
+
+def source_tokens(data: bytes) -> Optional[Set[Tuple[str, int]]]:
+    """Identifiers in a module's source, with the lines they appear on, or None
+    if fissix can't tokenize it.  Names in strings and comments are not
+    included, and neither are keywords."""
+    try:
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+        readline = io.StringIO(data.decode(encoding)).readline
+        return {
+            (value, start[0])
+            for type, value, start, _, _ in tokenize.generate_tokens(readline)
+            if type == token.NAME and not keyword.iskeyword(value)
+        }
+    except (SyntaxError, LookupError, UnicodeDecodeError, tokenize.TokenError):
+        return None
+
+
+class NameIndex:
+    """Lines where each identifier appears in each file, stored with SQLite.
+
+    Files are tokenized again only when their size or mtime changes and their
+    contents hash differently, so refreshing a large tree that has barely
+    changed mostly costs a `stat()` per file.  Files fissix can't tokenize are
+    recorded as containing every name.  Changes are written by `save()`; the
+    index is stored in `~/.cache/bowler/names.sqlite` by default.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Union[str, Path, None] = None) -> None:
+        self.path = Path(path).expanduser() if path else CACHE_DIR / "names.sqlite"
+        self.refreshed = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.db = self.connect()
+        except sqlite3.DatabaseError as e:
+            log.debug(f"discarding unreadable name index {self.path}: {e}")
+            self.path.unlink()
+            self.db = self.connect()
+
+    def connect(self) -> sqlite3.Connection:
+        # files are queued from a separate thread, but never concurrently
+        db = sqlite3.connect(str(self.path), check_same_thread=False)
+        if db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            db.executescript(
+                f"""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS names;
+                CREATE TABLE files (
+                    id INTEGER PRIMARY KEY,
+                    filename TEXT UNIQUE,
+                    mtime_ns INTEGER,
+                    size INTEGER,
+                    digest TEXT,
+                    tokenized INTEGER
+                );
+                CREATE TABLE names (
+                    name TEXT,
+                    file INTEGER,
+                    line INTEGER,
+                    PRIMARY KEY (name, file, line)
+                ) WITHOUT ROWID;
+                CREATE INDEX names_file ON names (file);
+                PRAGMA user_version = {self.VERSION};
+                """
+            )
+        return db
+
+    def refresh(self, filename: str) -> Optional[Tuple[int, bool]]:
+        """Bring a file's entry up to date, returning its id and whether it
+        could be tokenized, or None if it can't be read."""
+        filename = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        row = self.db.execute(
+            "SELECT id, mtime_ns, size, digest, tokenized FROM files "
+            "WHERE filename = ?",
+            (filename,),
+        ).fetchone()
+        if row is not None and row[1:3] == (stat.st_mtime_ns, stat.st_size):
+            return row[0], bool(row[4])
+
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        if row is not None and row[3] == digest:
+            self.db.execute(
+                "UPDATE files SET mtime_ns = ?, size = ? WHERE id = ?",
+                (stat.st_mtime_ns, stat.st_size, row[0]),
+            )
+            return row[0], bool(row[4])
+
+        names = source_tokens(data)
+        if row is not None:
+            self.db.execute("DELETE FROM names WHERE file = ?", (row[0],))
+        cursor = self.db.execute(
+            "INSERT OR REPLACE INTO files "
+            "(id, filename, mtime_ns, size, digest, tokenized) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                row[0] if row else None,
+                filename,
+                stat.st_mtime_ns,
+                stat.st_size,
+                digest,
+                names is not None,
+            ),
+        )
+        file_id = cast(int, cursor.lastrowid)
+        self.db.executemany(
+            "INSERT INTO names (name, file, line) VALUES (?, ?, ?)",
+            ((name, file_id, line) for name, line in names or ()),
+        )
+        self.refreshed += 1
+        return file_id, names is not None
+
+    def might_contain(self, filename: str, literals: List[List[str]]) -> bool:
+        """Whether a file contains all the names in any of the groups, ignoring
+        keywords, which aren't indexed."""
+        entry = self.refresh(filename)
+        if entry is None or not entry[1]:
+            return True
+        for names in literals:
+            for name in names:
+                if keyword.iskeyword(name):
+                    continue
+                found = self.db.execute(
+                    "SELECT 1 FROM names WHERE name = ? AND file = ? LIMIT 1",
+                    (name, entry[0]),
+                ).fetchone()
+                if found is None:
+                    break
+            else:
+                return True
+        return False
+
+    def occurrences(self, name: str) -> List[Tuple[str, int]]:
+        """Files and line numbers where a name appears, as of the last refresh."""
+        return self.db.execute(
+            "SELECT filename, line FROM names JOIN files ON files.id = names.file "
+            "WHERE name = ? ORDER BY filename, line",
+            (name,),
+        ).fetchall()
+
+    def update(
+        self, paths: List[str], filename_matcher: Optional[Callable[[str], bool]] = None
+    ) -> int:
+        """Index every Python file under the given paths, and forget files that
+        no longer exist, returning the number of files tokenized."""
+        refreshed = self.refreshed
+        for filename in python_files(paths, filename_matcher):
+            self.refresh(filename)
+        for file_id, filename in self.db.execute(
+            "SELECT id, filename FROM files"
+        ).fetchall():
+            if not os.path.exists(filename):
+                self.db.execute("DELETE FROM names WHERE file = ?", (file_id,))
+                self.db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        return self.refreshed - refreshed
+
+    def save(self) -> None:
+        try:
+            self.db.commit()
+        except sqlite3.Error as e:
+            log.debug(f"failed to write name index {self.path}: {e}")
+
+
+class PatternCache:
+    """Compiled fixer patterns, memoized by pattern text.
+
+    Each pattern is compiled along with a generated matcher function (see
+    `bowler.codegen`), whose code object is stored like bytecode.  Patterns are
+    kept in memory for the life of the process, and stored on disk so that later
+    runs can load them instead of compiling them again; only the `max_entries`
+    most recently written patterns are kept on disk.  Set `path` to None to only
+    cache patterns in memory.
+    """
+
+    VERSION = 2
+
+    def __init__(
+        self,
+        path: Union[str, Path, None] = CACHE_DIR / "patterns",
+        max_entries: int = 1024,
+    ) -> None:
+        self.path = Path(path).expanduser() if path else None
+        self.max_entries = max_entries
+        self.patterns: Dict[str, Tuple[Any, Any]] = {}
+        self.matchers: Dict[str, Matcher] = {}
+
+    def entry(self, pattern: str) -> Optional[Path]:
+        if self.path is None:
+            return None
+        from . import __version__
+
+        # generated code objects are only valid for the interpreter that made them
+        key = f"{self.VERSION}:{__version__}:{fissix_version}:{MAGIC_NUMBER.hex()}"
+        digest = hashlib.sha256(f"{key}:{pattern}".encode()).hexdigest()
+        return self.path / digest
+
+    def compile(self, pattern: str) -> Tuple[Any, Any]:
+        """Return the compiled pattern and its pattern tree, like
+        `PatternCompiler().compile_pattern(pattern, with_tree=True)`."""
+        if pattern not in self.patterns:
+            self.load(pattern)
+        return self.patterns[pattern]
+
+    def matcher(self, pattern: str) -> Matcher:
+        """Return a generated function that behaves like the compiled pattern's
+        `match(node, results)` method."""
+        if pattern not in self.matchers:
+            self.load(pattern)
+        return self.matchers[pattern]
+
+    def load(self, pattern: str) -> None:
+        data: Optional[Dict[str, Any]] = None
+        path = self.entry(pattern)
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    data = pickle.load(f)
+                code = marshal.loads(data["code"])
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                log.debug(f"discarding unreadable pattern cache entry {path}: {e}")
+                data = None
+
+        if data is None:
+            compiled, tree = PatternCompiler().compile_pattern(pattern, with_tree=True)
+            source, fallbacks = generate_matcher(compiled)
+            code = compile(source, f"<pattern {pattern[:40]!r}>", "exec")
+            data = {
+                "pattern": compiled,
+                "tree": tree,
+                "code": marshal.dumps(code),
+                "fallbacks": fallbacks,
+            }
+            if path is not None:
+                try:
+                    # pickled together, fallbacks stay parts of the pattern
+                    write_atomic(path, pickle.dumps(data))
+                    self.evict()
+                except (OSError, pickle.PicklingError, RecursionError) as e:
+                    log.debug(f"failed to write pattern cache entry {path}: {e}")
+
+        namespace: Dict[str, Any] = {"P": data["fallbacks"]}
+        exec(code, namespace)
+        self.patterns[pattern] = (data["pattern"], data["tree"])
+        self.matchers[pattern] = namespace["match"]
+
+    def evict(self) -> None:
+        """Remove the oldest entries on disk beyond `max_entries`."""
+        if self.path is None:
+            return
+        entries = []
+        for path in self.path.iterdir():
+            if path.name.startswith(".tmp"):
+                continue  # being written by another process
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries :]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+# set BOWLER_NO_PATTERN_CACHE to keep compiled patterns in memory only
+PATTERNS = PatternCache(
+    None if os.environ.get("BOWLER_NO_PATTERN_CACHE") else CACHE_DIR / "patterns"
+)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Generate Python matcher functions from compiled fissix patterns.
+
+fissix interprets patterns recursively, trying every way a wildcard could split
+a node's children between the sub-patterns.  Most patterns, including those of
+Bowler's selectors, have at most one variable-length wildcard among any node's
+children, so the children each sub-pattern covers follow from the number of
+children alone.  For these, the generator emits straight-line checks on node
+types, values, and child counts, with literal values checked before descending
+into nested nodes.  Sub-patterns it can't express this way are matched by the
+original pattern objects, so generated matchers agree with fissix on every tree.
+"""
+
+from itertools import count
+from typing import Callable, List, Optional, Set, Tuple
+
+from fissix.pgen2 import token
+from fissix.pytree import (
+    HUGE,
+    BasePattern,
+    LeafPattern,
+    NegatedPattern,
+    NodePattern,
+    WildcardPattern,
+)
+
+from .types import LN, Capture
+
+Matcher = Callable[[LN, Capture], bool]
+
+
+def is_single(pattern: BasePattern) -> bool:
+    """Whether the pattern always matches exactly one node."""
+    if isinstance(pattern, (LeafPattern, NodePattern)):
+        return True
+    return (
+        isinstance(pattern, WildcardPattern)
+        and pattern.min == pattern.max == 1
+        and pattern.content is not None
+        and pattern.name != "bare_name"
+        and all(len(alt) == 1 and is_single(alt[0]) for alt in pattern.content)
+    )
+
+
+def is_named(pattern: BasePattern) -> bool:
+    """Whether the pattern, or any pattern within it, binds a name."""
+    if pattern.name:
+        return True
+    if isinstance(pattern, NegatedPattern) or pattern.content is None:
+        return False
+    if isinstance(pattern, WildcardPattern):
+        return any(is_named(p) for alt in pattern.content for p in alt)
+    if isinstance(pattern, NodePattern):
+        return any(is_named(p) for p in pattern.content)
+    return False
+
+
+def is_any(pattern: BasePattern) -> bool:
+    return (
+        isinstance(pattern, NodePattern)
+        and pattern.type is None
+        and pattern.content is None
+        and not pattern.name
+    )
+
+
+def is_run(pattern: BasePattern) -> bool:
+    """Whether the pattern repeats single, unnamed nodes, like `any*`."""
+    return (
+        isinstance(pattern, WildcardPattern)
+        and pattern.name != "bare_name"
+        and (
+            pattern.content is None
+            or all(
+                len(alt) == 1 and is_single(alt[0]) and not is_named(alt[0])
+                for alt in pattern.content
+            )
+        )
+    )
+
+
+def flatten(patterns: List[BasePattern]) -> List[BasePattern]:
+    """Splice unnamed, unrepeated groups into the surrounding sequence."""
+    result: List[BasePattern] = []
+    for pattern in patterns:
+        if (
+            isinstance(pattern, WildcardPattern)
+            and pattern.min == pattern.max == 1
+            and not pattern.name
+            and pattern.content is not None
+            and len(pattern.content) == 1
+        ):
+            result.extend(flatten(pattern.content[0]))
+        else:
+            result.append(pattern)
+    return result
+
+
+def indent(lines: List[str]) -> List[str]:
+    return ["    " + line for line in lines]
+
+
+class MatcherGenerator:
+    """Generates the source of a module defining `match(node, results)`.
+
+    Checks are emitted before any results are written, so a failed match
+    leaves `results` untouched, and names are bound in the same order as
+    fissix binds them.  `fallbacks` holds the patterns the generated code
+    delegates to, which it expects to find as `P` in its globals.
+    """
+
+    def __init__(self) -> None:
+        self.functions: List[str] = []
+        self.fallbacks: List[BasePattern] = []
+        self.counter = count()
+
+    def local(self, prefix: str) -> str:
+        return f"{prefix}{next(self.counter)}"
+
+    def generate(self, pattern: BasePattern) -> str:
+        if is_single(pattern):
+            entry = self.function(pattern)
+        else:
+            self.fallbacks.append(pattern)
+            entry = f"P[{len(self.fallbacks) - 1}].match"
+        return "\n\n".join(self.functions + [f"match = {entry}\n"])
+
+    def function(self, pattern: BasePattern) -> str:
+        """Emit a function matching one node, and return its name."""
+        name = self.local("match_")
+        checks: List[str] = []
+        writes: List[str] = []
+        self.node(pattern, "node", checks, writes)
+        lines = [f"def {name}(node, results):"] + indent(
+            checks + writes + ["return True"]
+        )
+        self.functions.append("\n".join(lines))
+        return name
+
+    def fallback(
+        self, pattern: BasePattern, expr: str, checks: List[str], writes: List[str]
+    ) -> None:
+        self.fallbacks.append(pattern)
+        r = self.local("r")
+        checks.append(f"{r} = {{}}")
+        checks.append(
+            f"if not P[{len(self.fallbacks) - 1}].match({expr}, {r}): return False"
+        )
+        writes.append(f"results.update({r})")
+
+    def node(
+        self, pattern: BasePattern, expr: str, checks: List[str], writes: List[str]
+    ) -> None:
+        """Emit checks that `expr` matches a pattern matching a single node."""
+        if isinstance(pattern, LeafPattern):
+            if pattern.type is None:
+                checks.append(f"if {expr}.type >= 256: return False")
+            else:
+                checks.append(f"if {expr}.type != {pattern.type}: return False")
+            if pattern.content is not None:
+                checks.append(f"if {expr}.value != {pattern.content!r}: return False")
+            if pattern.name:
+                writes.append(f"results[{pattern.name!r}] = {expr}")
+
+        elif isinstance(pattern, NodePattern):
+            if pattern.type is not None:
+                checks.append(f"if {expr}.type != {pattern.type}: return False")
+            plan = None
+            if pattern.content is not None:
+                plan = self.plan(pattern.content)
+                if plan is None:
+                    self.fallback(pattern, expr, checks, writes)
+                    return
+            if plan is not None:
+                self.children(plan, expr, checks, writes)
+            if pattern.name:
+                writes.append(f"results[{pattern.name!r}] = {expr}")
+
+        else:
+            # alternatives: the first one that matches binds its names
+            r = self.local("r")
+            calls = " or ".join(
+                f"{self.function(alt[0])}({expr}, {r})" for alt in pattern.content
+            )
+            checks.append(f"{r} = {{}}")
+            checks.append(f"if not ({calls}): return False")
+            writes.append(f"results.update({r})")
+            if pattern.name:
+                writes.append(f"results[{pattern.name!r}] = [{expr}]")
+
+    def plan(
+        self, content: List[BasePattern]
+    ) -> Optional[Tuple[List[BasePattern], Optional[int]]]:
+        """Return the flattened children patterns, and the index of the one
+        variable-length run among them, if the children can be matched by
+        position alone."""
+        patterns = flatten(content)
+        run = None
+        for index, pattern in enumerate(patterns):
+            if is_single(pattern):
+                continue
+            if run is not None or not is_run(pattern):
+                return None
+            run = index
+        return patterns, run
+
+    def children(
+        self,
+        plan: Tuple[List[BasePattern], Optional[int]],
+        expr: str,
+        checks: List[str],
+        writes: List[str],
+    ) -> None:
+        patterns, run = plan
+        ch = self.local("ch")
+        checks.append(f"{ch} = {expr}.children")
+
+        fixed = len(patterns) - (run is not None)
+        if run is None:
+            checks.append(f"if len({ch}) != {fixed}: return False")
+            after = 0
+        else:
+            wildcard = patterns[run]
+            after = len(patterns) - run - 1
+            if fixed + wildcard.min:
+                checks.append(f"if len({ch}) < {fixed + wildcard.min}: return False")
+            if wildcard.max < HUGE:
+                checks.append(f"if len({ch}) > {fixed + wildcard.max}: return False")
+
+        # children after the run are indexed from the end
+        def position(index: int) -> int:
+            if run is None or index < run:
+                return index
+            return index - len(patterns)
+
+        literals: List[str] = []
+        others: List[str] = []
+        element_writes: List[List[str]] = []
+        for index, pattern in enumerate(patterns):
+            element_writes.append([])
+            if index == run:
+                self.run(pattern, ch, run, after, others, element_writes[-1])
+                continue
+            n = self.local("n")
+            target = literals if is_literal(pattern) else others
+            target.append(f"{n} = {ch}[{position(index)}]")
+            self.node(pattern, n, target, element_writes[-1])
+
+        checks.extend(literals + others)
+        for lines in element_writes:
+            writes.extend(lines)
+
+    def run(
+        self,
+        pattern: WildcardPattern,
+        ch: str,
+        start: int,
+        after: int,
+        checks: List[str],
+        writes: List[str],
+    ) -> None:
+        nodes = f"{ch}[{start}:{-after if after else ''}]"
+        if pattern.content is not None and not all(
+            is_any(alt[0]) for alt in pattern.content
+        ):
+            calls = " or ".join(
+                f"{self.function(alt[0])}(n, results)" for alt in pattern.content
+            )
+            checks.append(f"for n in {nodes}:")
+            checks.append(f"    if not ({calls}): return False")
+        if pattern.name:
+            writes.append(f"results[{pattern.name!r}] = {nodes}")
+
+
+def required_names(pattern: BasePattern) -> Set[str]:
+    """NAME leaf values (including keywords) that every node matching the
+    pattern must contain."""
+    if isinstance(pattern, LeafPattern):
+        value = pattern.content
+        if (
+            pattern.type in (None, token.NAME)
+            and isinstance(value, str)
+            and value.isidentifier()
+        ):
+            return {value}
+        return set()
+    if isinstance(pattern, NodePattern):
+        names: Set[str] = set()
+        for child in pattern.content or ():
+            names |= required_names(child)
+        return names
+    if isinstance(pattern, WildcardPattern) and pattern.content and pattern.min:
+        alternatives = []
+        for alt in pattern.content:
+            names = set()
+            for child in alt:
+                names |= required_names(child)
+            alternatives.append(names)
+        return set.intersection(*alternatives)
+    return set()
+
+
+def is_literal(pattern: BasePattern) -> bool:
+    return isinstance(pattern, LeafPattern) and pattern.content is not None
+
+
+def generate_matcher(pattern: BasePattern) -> Tuple[str, List[BasePattern]]:
+    """Return the source of a matcher for a compiled pattern, and the patterns
+    it delegates to.  Executing the source with `P` bound to those patterns
+    defines `match(node, results)`, which behaves like `pattern.match()`."""
+    generator = MatcherGenerator()
+    source = generator.generate(pattern)
+    return source, generator.fallbacks
@@ -6,7 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
-from typing import List, Optional, Sequence, Union
+from typing import Container, Dict, List, Optional, Sequence, Set, Tuple, Union
 
 import click
 from fissix.pgen2.token import tok_name
@@ -202,6 +202,163 @@ def get_class(node: LN) -> LN:
     raise ValueError(f"classdef node not found")
 
 
+class TreeIndex:
+    """Nodes of a parsed tree, indexed by type and by NAME leaf value.
+
+    Use `TreeIndex.of(node)` to get the index of the tree containing `node`,
+    which is built once per tree.  Node lists are in post-order.  The index
+    describes the tree as it was built: lookups skip nodes that have since been
+    removed from the tree, but don't include nodes added since.
+    """
+
+    def __init__(self, root: LN) -> None:
+        self.root = root
+        self.post_order: List[LN] = []
+        self.types: Dict[int, List[LN]] = {}
+        self.names: Dict[str, List[LN]] = {}
+
+        stack = [(root, iter(root.children))]
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, iter(child.children)))
+                continue
+            stack.pop()
+            self.post_order.append(node)
+
+        for node in self.post_order:
+            self.types.setdefault(node.type, []).append(node)
+            if node.type == TOKEN.NAME:
+                self.names.setdefault(node.value, []).append(node)
+
+    @classmethod
+    def of(cls, node: LN) -> "TreeIndex":
+        while node.parent is not None:
+            node = node.parent
+        index = getattr(node, "bowler_index", None)
+        if index is None:
+            index = cls(node)
+            node.bowler_index = index  # type: ignore
+        return index
+
+    def attached(self, node: LN) -> bool:
+        """Whether `node` is still part of the indexed tree."""
+        if not self.root.was_changed:
+            return True
+        while node.parent is not None:
+            node = node.parent
+        return node is self.root
+
+    def nodes(self, type: int) -> List[LN]:
+        """Nodes of the given symbol or token type."""
+        return [node for node in self.types.get(type, ()) if self.attached(node)]
+
+    def leaves(self, value: str) -> List[LN]:
+        """NAME leaves (including keywords) with the given value."""
+        return [node for node in self.names.get(value, ()) if self.attached(node)]
+
+    def containing(self, value: str, types: Container[int]) -> List[LN]:
+        """Nodes of the given types that contain a NAME leaf with the given
+        value, in post-order."""
+        seen = set()
+        found = set()
+        for leaf in self.leaves(value):
+            node: Optional[LN] = leaf
+            while node is not None and id(node) not in seen:
+                seen.add(id(node))
+                if node.type in types:
+                    found.add(id(node))
+                node = node.parent
+        if not found:
+            return []
+        return [node for node in self.post_order if id(node) in found]
+
+
+class ScopeMap:
+    """The enclosing class and function of nodes in a parsed tree.
+
+    Use `ScopeMap.of(node)` to get the map of the tree containing `node`, which is
+    kept for the life of the tree.  Scopes are found lazily and remembered for
+    every node on the way, so each lookup only walks up to the nearest node
+    already seen.  A node's enclosing class or function is the nearest classdef
+    or funcdef containing it, or the node itself if it is one.  Like
+    `TreeIndex`, the map describes the tree as nodes were first looked up, and
+    doesn't notice nodes that are moved elsewhere afterwards.
+    """
+
+    latest: Optional["ScopeMap"] = None
+
+    def __init__(self, root: LN) -> None:
+        self.root = root
+        # id(node) -> (node, enclosing class, enclosing function)
+        self.scopes: Dict[int, Tuple[LN, Optional[LN], Optional[LN]]] = {
+            id(root): (root, None, None)
+        }
+        # id(classdef) -> NAME leaves of the class header, before the colon
+        self.headers: Dict[int, List[Leaf]] = {}
+
+    @classmethod
+    def of(cls, node: LN) -> "ScopeMap":
+        # filters usually look up many nodes of the same tree in a row
+        latest = cls.latest
+        while node.parent is not None:
+            if latest is not None:
+                entry = latest.scopes.get(id(node))
+                if entry is not None and entry[0] is node:
+                    return latest
+            node = node.parent
+
+        scopes = getattr(node, "bowler_scopes", None)
+        if scopes is None:
+            scopes = cls(node)
+            node.bowler_scopes = scopes  # type: ignore
+        cls.latest = scopes
+        return scopes
+
+    def lookup(self, node: LN) -> Tuple[Optional[LN], Optional[LN]]:
+        """The enclosing class and function of `node`."""
+        path = []
+        entry = self.scopes.get(id(node))
+        while entry is None or entry[0] is not node:
+            path.append(node)
+            if node.parent is None:  # not part of this tree
+                cls = func = None
+                break
+            node = node.parent
+            entry = self.scopes.get(id(node))
+        else:
+            _, cls, func = entry
+
+        classdef, funcdef = SYMBOL.classdef, SYMBOL.funcdef
+        for node in reversed(path):
+            if node.type == classdef:
+                cls = node
+            elif node.type == funcdef:
+                func = node
+            self.scopes[id(node)] = (node, cls, func)
+        return cls, func
+
+    def enclosing_class(self, node: LN) -> Optional[LN]:
+        return self.lookup(node)[0]
+
+    def enclosing_function(self, node: LN) -> Optional[LN]:
+        return self.lookup(node)[1]
+
+    def bases(self, node: LN) -> Set[str]:
+        """Names in the header of a classdef, including its name and bases."""
+        leaves = self.headers.get(id(node))
+        if leaves is None:
+            leaves = []
+            for leaf in node.leaves():
+                if leaf.type == TOKEN.COLON:
+                    break
+                if leaf.type == TOKEN.NAME:
+                    leaves.append(leaf)
+            self.headers[id(node)] = leaves
+        return {leaf.value for leaf in leaves}
+
+
 class Once:
     """Simple object that evaluates to True once, and then always False."""
 
@@ -13,10 +13,11 @@ import sys
 import unittest
 from importlib.abc import Loader
 from pathlib import Path
-from typing import List, cast
+from typing import List, Optional, cast
 
 import click
 
+from .cache import ImportIndex, NameIndex
 from .query import Query
 from .tool import BowlerTool
 from .types import START, SYMBOL, TOKEN
@@ -64,6 +65,39 @@ def dump(selector_pattern: bool, paths: List[str]) -> None:
     return Query(paths).select_root().dump(selector_pattern).retcode
 
 
+@main.command()
+@click.option("--index", "index_path", type=click.Path(), help="Import index location")
+@click.option("--names", "names_path", type=click.Path(), help="Name index location")
+@click.argument("paths", type=click.Path(exists=True), nargs=-1, required=True)
+def index(
+    index_path: Optional[str], names_path: Optional[str], paths: List[str]
+) -> None:
+    """Index the imports and identifiers of each file in <paths>."""
+    import_index = ImportIndex(index_path)
+    refreshed = import_index.update(paths)
+    import_index.save()
+    click.echo(f"{len(import_index.records)} files indexed, {refreshed} updated")
+
+    name_index = NameIndex(names_path)
+    refreshed = name_index.update(paths)
+    name_index.save()
+    click.echo(f"{refreshed} files tokenized")
+
+
+@main.command()
+@click.option("--names", "names_path", type=click.Path(), help="Name index location")
+@click.argument("name", required=True)
+@click.argument("paths", type=click.Path(exists=True), nargs=-1, required=False)
+def where(names_path: Optional[str], name: str, paths: List[str]) -> None:
+    """List the lines where <name> is used, refreshing <paths> in the index."""
+    name_index = NameIndex(names_path)
+    if paths:
+        name_index.update(paths)
+        name_index.save()
+    for filename, line in name_index.occurrences(name):
+        click.echo(f"{filename}:{line}")
+
+
 @main.command()
 @click.option("-i", "--interactive", is_flag=True)
 @click.argument("query", required=False)
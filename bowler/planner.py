@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""bowler.planner
+
+Evaluate a transform's filters while measuring how often each one passes and
+how long it takes.
+
+A `FilterPlan` runs filters the way `all()` would, stopping at the first one
+that rejects a match.  When `adaptive` is set, it periodically reorders them so
+that filters which are cheap and likely to reject run first: filters are sorted
+by their average cost divided by how often they reject, which minimizes the
+expected cost of a chain of independent filters.  Filters marked with
+`constant_cost`, like the ones behind `.is_call()` and `.is_def()`, aren't timed
+and always go first.  Reordering assumes filters don't depend on each other, or
+on the order they run in.
+
+    >>> plan = FilterPlan(transform.filters, adaptive=True)
+    >>> plan(node, capture, filename)  # True if every filter passes
+    >>> plan.report()  # one line of statistics per filter
+"""
+
+import time
+from typing import List
+
+from attr import dataclass
+
+from .types import LN, Capture, Filename, Filter
+
+__all__ = ["FilterPlan", "FilterStats", "constant_cost"]
+
+
+def constant_cost(filter: Filter) -> Filter:
+    """Mark a filter as cheap enough to always run first, without timing it."""
+    filter.bowler_constant_cost = True  # type: ignore
+    return filter
+
+
+@dataclass(eq=False)
+class FilterStats:
+    filter: Filter
+    index: int  # position in the transform's filters
+    constant: bool = False
+    calls: int = 0
+    passed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return getattr(self.filter, "__name__", repr(self.filter))
+
+    def rank(self) -> float:
+        """Expected cost of running this filter per match it rejects.  Filters
+        that haven't run yet rank first, so that they get measured."""
+        if self.constant or not self.calls:
+            return 0.0
+        cost = self.seconds / self.calls
+        # smoothed, so that filters that never rejected yet still rank
+        rejected = (self.calls - self.passed + 1) / (self.calls + 2)
+        return cost / rejected
+
+
+class FilterPlan:
+    # matches evaluated between reorderings, when adaptive
+    REPLAN_INTERVAL = 64
+
+    def __init__(self, filters: List[Filter], adaptive: bool = False) -> None:
+        self.stats = [
+            FilterStats(f, index, getattr(f, "bowler_constant_cost", False))
+            for index, f in enumerate(filters)
+        ]
+        self.order = list(self.stats)
+        self.adaptive = adaptive
+        self.evaluated = 0
+
+    def __call__(self, node: LN, capture: Capture, filename: Filename) -> bool:
+        self.evaluated += 1
+        if self.adaptive and self.evaluated % self.REPLAN_INTERVAL == 0:
+            self.replan()
+
+        clock = time.perf_counter
+        for stats in self.order:
+            stats.calls += 1
+            if stats.constant:
+                result = stats.filter(node, capture, filename)
+            else:
+                before = clock()
+                result = stats.filter(node, capture, filename)
+                stats.seconds += clock() - before
+            if not result:
+                return False
+            stats.passed += 1
+        return True
+
+    def replan(self) -> None:
+        """Order filters by rank, keeping filters of equal rank in the order they
+        were added."""
+        self.order = sorted(self.stats, key=lambda s: (s.rank(), s.index))
+
+    def report(self) -> List[str]:
+        """Statistics for each filter, in the order they currently run."""
+        lines = []
+        for stats in self.order:
+            rate = 100 * stats.passed / max(1, stats.calls)
+            line = f"{stats.name}: {stats.calls} calls, {rate:.0f}% passed"
+            if not stats.constant:
+                micros = 1e6 * stats.seconds / max(1, stats.calls)
+                line += f", {micros:.1f}us per call"
+            lines.append(line)
+        return lines
@@ -5,20 +5,26 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
 import inspect
 import logging
 import pathlib
 import re
 from functools import wraps
-from typing import Callable, List, Optional, Type, TypeVar, Union, cast
+from typing import Callable, List, Optional, Tuple, Type, TypeVar, Union, cast
 
+from fissix import __version__ as fissix_version
 from fissix.fixer_base import BaseFix
 from fissix.fixer_util import Attr, Comma, Dot, LParen, Name, Newline, RParen
 from fissix.pytree import Leaf, Node, type_repr
 
+from .cache import PATTERNS, ImportIndex, NameIndex, ResultCache, describe
+from .codegen import required_names
 from .helpers import (
     Once,
+    ScopeMap,
     dotted_parts,
+    filename_endswith,
     find_first,
     find_last,
     find_previous,
@@ -29,6 +35,8 @@ from .helpers import (
     quoted_parts,
 )
 from .imr import FunctionArgument, FunctionSpec
+from .planner import FilterPlan, constant_cost
+from .symbols import FUNCTION_SCOPES, SymbolTable, selected_name
 from .tool import BowlerTool
 from .types import (
     LN,
@@ -49,6 +57,29 @@ from .types import (
 )
 
 SELECTORS = {}
+# selectors whose patterns only match when `name` appears in the source; these
+# are also the ones the bottom matcher finds exactly the same matches for
+NAME_SELECTORS = {
+    "attribute",
+    "class",
+    "function",
+    "method",
+    "module",
+    "subclass",
+    "var",
+}
+BM_SELECTORS = NAME_SELECTORS
+# the capture holding the NAME leaf each selector selects
+SELECTED_NAMES = {
+    "attribute": "attr_name",
+    "class": "class_name",
+    "function": "function_name",
+    "method": "function_name",
+    "subclass": "class_name",
+    "var": "var_name",
+}
+# zero-width assertions that can depend on what follows a matched directory
+PATH_ASSERTIONS = re.compile(r"\$|\\[ZbB]|\(\?[=!]")
 Q = TypeVar("Q", bound="Query")
 QM = Callable[..., Q]
 
@@ -83,6 +114,25 @@ def selector(pattern: str) -> Callable[[QM], QM]:
     return wrapper
 
 
+def required_literals(
+    transform: Transform, pattern: Optional[str] = None
+) -> Optional[List[str]]:
+    """Names that must appear in a file for the transform's selector to match,
+    or None when the selector can match arbitrary source.
+
+    Names come from the selector's arguments, and if given, from the NAME
+    leaves that every match of the compiled `pattern` contains.
+    """
+    literals: List[str] = []
+    name = transform.kwargs.get("name")
+    if not transform.fixer and transform.selector in NAME_SELECTORS and name:
+        literals = [part for part in dotted_parts(name) if part != "."]
+    if pattern is not None:
+        names = required_names(PATTERNS.compile(pattern)[0])
+        literals += sorted(names - set(literals))
+    return literals or None
+
+
 class Query:
     def __init__(
         self,
@@ -410,29 +460,46 @@ class Query:
         return self.transforms[-1]
 
     def is_filename(self, include: str = None, exclude: str = None) -> "Query":
+        transform = self.current
+
         if include:
-            regex = re.compile(include)
+            include_regex = re.compile(include)
 
+            def match_include(filename: Filename) -> bool:
+                return include_regex.search(filename) is not None
+
+            @constant_cost
             def filter_filename_include(
                 node: LN, capture: Capture, filename: Filename
             ) -> bool:
-                return regex.search(filename) is not None
+                return match_include(filename)
 
-            self.current.filters.append(filter_filename_include)
+            transform.filters.append(filter_filename_include)
+            transform.filename_matchers.append(match_include)
 
         if exclude:
-            regex = re.compile(exclude)
+            exclude_regex = re.compile(exclude)
+
+            def match_exclude(filename: Filename) -> bool:
+                return exclude_regex.search(filename) is None
 
+            @constant_cost
             def filter_filename_exclude(
                 node: LN, capture: Capture, filename: Filename
             ) -> bool:
-                return regex.search(filename) is None
+                return match_exclude(filename)
 
-            self.current.filters.append(filter_filename_exclude)
+            transform.filters.append(filter_filename_exclude)
+            transform.filename_matchers.append(match_exclude)
+            # A match inside "dir/" is also a match for every path below it,
+            # unless the pattern asserts something about what follows.
+            if not PATH_ASSERTIONS.search(exclude):
+                transform.directory_matchers.append(match_exclude)
 
         return self
 
     def is_call(self) -> "Query":
+        @constant_cost
         def filter_is_call(node: LN, capture: Capture, filename: Filename) -> bool:
             return bool("function_call" in capture or "class_call" in capture)
 
@@ -440,6 +507,7 @@ class Query:
         return self
 
     def is_def(self) -> "Query":
+        @constant_cost
         def filter_is_def(node: LN, capture: Capture, filename: Filename) -> bool:
             return bool("function_def" in capture or "class_def" in capture)
 
@@ -448,24 +516,77 @@ class Query:
 
     def in_class(self, class_name: str, include_subclasses: bool = True) -> "Query":
         def filter_in_class(node: LN, capture: Capture, filename: Filename) -> bool:
-            while node.parent is not None:
-                if node.type == SYMBOL.classdef:
-                    if node.children[1].value == class_name:
-                        return True
-                    if not include_subclasses:
-                        return False
-                    for leaf in node.leaves():
-                        if leaf.type == TOKEN.COLON:
-                            break
-                        elif leaf.type == TOKEN.NAME and leaf.value == class_name:
-                            return True
-                    return False
-                node = node.parent
-            return False
+            scopes = ScopeMap.of(node)
+            cls = scopes.enclosing_class(node)
+            if cls is None:
+                return False
+            if cls.children[1].value == class_name:
+                return True
+            return include_subclasses and class_name in scopes.bases(cls)
 
         self.current.filters.append(filter_in_class)
         return self
 
+    def in_function(self, function_name: Optional[str] = None) -> "Query":
+        def filter_in_function(node: LN, capture: Capture, filename: Filename) -> bool:
+            function = SymbolTable.of(node).scope(node).function
+            if function is None:
+                return False
+            return function_name is None or (
+                function.node.children[1].value == function_name
+            )
+
+        self.current.filters.append(filter_in_function)
+        return self
+
+    def is_local(self) -> "Query":
+        key = SELECTED_NAMES.get(self.current.selector)
+
+        def filter_is_local(node: LN, capture: Capture, filename: Filename) -> bool:
+            leaf = selected_name(node, capture, key)
+            if leaf is None:
+                return False
+            scope = SymbolTable.of(leaf).lookup(leaf)
+            return scope is not None and scope.kind in FUNCTION_SCOPES
+
+        self.current.filters.append(filter_is_local)
+        return self
+
+    def is_global(self) -> "Query":
+        key = SELECTED_NAMES.get(self.current.selector)
+
+        def filter_is_global(node: LN, capture: Capture, filename: Filename) -> bool:
+            leaf = selected_name(node, capture, key)
+            if leaf is None:
+                return False
+            scope = SymbolTable.of(leaf).lookup(leaf)
+            return scope is not None and scope.kind == "module"
+
+        self.current.filters.append(filter_is_global)
+        return self
+
+    def binds_to_import(self, module: Optional[str] = None) -> "Query":
+        key = SELECTED_NAMES.get(self.current.selector)
+
+        def filter_binds_to_import(
+            node: LN, capture: Capture, filename: Filename
+        ) -> bool:
+            leaf = selected_name(node, capture, key)
+            if leaf is None:
+                return False
+            for binding in SymbolTable.of(leaf).bindings(leaf):
+                if binding.kind != "import":
+                    continue
+                imported = cast(str, binding.module)
+                if module is None or imported == module:
+                    return True
+                if imported.startswith(module + "."):
+                    return True
+            return False
+
+        self.current.filters.append(filter_binds_to_import)
+        return self
+
     def encapsulate(self, internal_name: str = "") -> "Query":
         transform = self.current
         if transform.selector not in ("attribute"):
@@ -930,7 +1051,9 @@ class Query:
             pattern = transform.fixer.PATTERN
 
         else:
-            bm_compat = False
+            # the bottom matcher applies each fixer to the whole tree in turn,
+            # rather than interleaving transforms node by node
+            bm_compat = transform.selector in BM_SELECTORS and len(self.transforms) == 1
             log.debug(f"select {transform.selector}[{transform.kwargs}]")
             pattern = SELECTORS[transform.selector].format(**transform.kwargs)
 
@@ -943,8 +1066,11 @@ class Query:
 
             log.debug(f"generated pattern: {pattern}")
 
+        literals = required_literals(transform, pattern)
         filters = transform.filters
         callbacks = transform.callbacks
+        plan = FilterPlan(filters)
+        selector = transform.selector
 
         log.debug(f"registered {len(filters)} filters: {filters}")
         log.debug(f"registered {len(callbacks)} callbacks: {callbacks}")
@@ -952,11 +1078,26 @@ class Query:
         class Fixer(BaseFix):
             PATTERN = pattern  # type: ignore
             BM_compatible = bm_compat
+            LITERALS = literals
+            PLAN = plan
+            SELECTOR = selector
+
+            def compile_pattern(self) -> None:
+                self.pattern, self.pattern_tree = PATTERNS.compile(self.PATTERN)
+                self.matcher = PATTERNS.matcher(self.PATTERN)
+
+            def match(self, node: LN) -> Union[bool, Capture]:
+                results: Capture = {"node": node}
+                return self.matcher(node, results) and results
 
             def transform(self, node: LN, capture: Capture) -> Optional[LN]:
                 filename = cast(Filename, self.filename)
                 returned_node = None
-                if not filters or all(f(node, capture, filename) for f in filters):
+                if not filters or plan(node, capture, filename):
+                    if transform.fixer or callbacks:
+                        # callbacks may edit leaves in place without calling
+                        # changed(), so mark the tree dirty before they run
+                        node.changed()
                     if transform.fixer:
                         returned_node = transform.fixer().transform(node, capture)
                     for callback in callbacks:
@@ -982,8 +1123,79 @@ class Query:
 
         return fixers
 
+    def hoist_filename_matchers(
+        self,
+    ) -> Tuple[Optional[FilenameMatcher], Optional[FilenameMatcher]]:
+        """Lift is_filename() filters out of the fixers and into file discovery.
+
+        A file (or directory) only needs to be visited if at least one transform
+        would accept it, so matchers are only returned when every transform
+        restricts filenames; files and directories they reject are never opened.
+        """
+        transforms = self.transforms
+        filename_matcher: Optional[FilenameMatcher] = None
+        directory_matcher: Optional[FilenameMatcher] = None
+
+        if transforms and all(t.filename_matchers for t in transforms):
+
+            def match_filename(filename: Filename) -> bool:
+                return any(
+                    all(m(filename) for m in t.filename_matchers) for t in transforms
+                )
+
+            filename_matcher = match_filename
+
+        if transforms and all(t.directory_matchers for t in transforms):
+
+            def match_directory(dirname: Filename) -> bool:
+                return any(
+                    all(m(dirname) for m in t.directory_matchers) for t in transforms
+                )
+
+            directory_matcher = match_directory
+
+        return filename_matcher, directory_matcher
+
+    def fingerprint(self, fixers: List[Type[BaseFix]]) -> str:
+        """Identify what this query does to a file, for incremental runs."""
+        from . import __version__
+
+        digest = hashlib.sha256()
+        digest.update(f"{__version__}:{fissix_version}:{self.python_version}".encode())
+        for transform, fixer in zip(self.transforms, fixers):
+            parts = [
+                fixer.PATTERN,
+                describe(transform.kwargs),
+                describe(transform.filters),
+                describe(transform.callbacks),
+                describe(transform.fixer),
+            ]
+            digest.update("\0".join(str(part) for part in parts).encode())
+        return digest.hexdigest()
+
+    def imported_modules(self) -> Optional[List[str]]:
+        """Modules selected by the query, if every transform selects a module.
+
+        Only files that import one of these, or one of their submodules or
+        parent packages, can match the query."""
+        modules = []
+        for transform in self.transforms:
+            if transform.selector != "module":
+                return None
+            modules.append(transform.kwargs["name"])
+        return modules or None
+
     def execute(self, **kwargs) -> "Query":
         fixers = self.compile()
+        if kwargs.pop("incremental", False):
+            kwargs.setdefault("result_cache", ResultCache(self.fingerprint(fixers)))
+        name_index = kwargs.pop("name_index", None)
+        if name_index is True:
+            name_index = NameIndex()
+        kwargs["name_index"] = name_index or None
+        if kwargs.pop("reorder_filters", False):
+            for fixer in fixers:
+                fixer.PLAN.adaptive = True  # type: ignore
         if self.processors:
 
             def processor(filename: Filename, hunk: Hunk) -> bool:
@@ -995,12 +1207,33 @@ class Query:
 
             kwargs["hunk_processor"] = processor
 
-        kwargs.setdefault("filename_matcher", self.filename_matcher)
+        filename_matcher, directory_matcher = self.hoist_filename_matchers()
+        if "filename_matcher" not in kwargs:
+            kwargs["filename_matcher"] = self.filename_matcher
+            if filename_matcher:
+                default_matcher = self.filename_matcher or filename_endswith(".py")
+                kwargs["filename_matcher"] = lambda filename: default_matcher(
+                    filename
+                ) and filename_matcher(filename)
+        kwargs.setdefault("directory_matcher", directory_matcher)
+
+        import_index = kwargs.pop("import_index", None)
+        if import_index is True:
+            import_index = ImportIndex()
+        modules = self.imported_modules()
+        if import_index and modules:
+            base_matcher = kwargs["filename_matcher"] or filename_endswith(".py")
+            kwargs["filename_matcher"] = lambda filename: base_matcher(
+                filename
+            ) and import_index.might_import(filename, modules)
+
         if self.python_version == 3:
             kwargs.setdefault("options", {})["print_function"] = True
         tool = BowlerTool(fixers, **kwargs)
         self.retcode = tool.run(self.paths)
         self.exceptions = tool.exceptions
+        if import_index and modules:
+            import_index.save()
         return self
 
     def dump(self, selector_pattern=False) -> "Query":
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""bowler.symbols
+
+Find the scope each name in a file belongs to, and what binds it.
+
+A `SymbolTable` records the scopes of a parsed file (the module, classes,
+functions, lambdas, and comprehensions), the names bound in each one by
+definitions, parameters, assignments, loops, `with` and `except` targets, and
+imports, and the scope of every leaf.  Names are resolved the way Python
+resolves them at compile time: `global` and `nonlocal` declarations are
+honored, and class bodies are skipped when resolving names in nested scopes.
+Which of several bindings of a name is live at a given point isn't tracked.
+
+    >>> table = SymbolTable.of(leaf)
+    >>> scope = table.lookup(leaf)  # where the name is bound, or None for builtins
+    >>> table.bindings(leaf)  # every binding of the name in that scope
+"""
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from attr import Factory, dataclass
+from fissix.pytree import Leaf
+
+from .types import LN, SYMBOL, TOKEN, Capture
+
+__all__ = ["Binding", "Scope", "SymbolTable", "selected_name"]
+
+FUNCTION_SCOPES = {"function", "lambda", "comprehension"}
+# nodes holding a comprehension's element and its comp_for clauses
+COMPREHENSIONS = {
+    SYMBOL.argument,
+    SYMBOL.dictsetmaker,
+    SYMBOL.listmaker,
+    SYMBOL.testlist_gexp,
+}
+
+
+@dataclass
+class Binding:
+    name: str
+    node: Leaf  # the NAME leaf being bound
+    kind: str  # "def", "class", "param", "assign", "for", "with", "except", "import"
+    module: Optional[str] = None  # for imports, the module the name comes from
+    imported: Optional[str] = None  # for `from` imports, the name imported
+
+
+@dataclass(eq=False, repr=False)
+class Scope:
+    kind: str  # "module", "class", "function", "lambda", or "comprehension"
+    node: LN
+    parent: Optional["Scope"] = None
+    bindings: Dict[str, List[Binding]] = Factory(dict)
+    globals: Set[str] = Factory(set)
+    nonlocals: Set[str] = Factory(set)
+
+    def __repr__(self) -> str:
+        return f"<Scope {self.kind} at line {self.node.get_lineno()}>"
+
+    @property
+    def function(self) -> Optional["Scope"]:
+        """The nearest enclosing function definition, skipping other scopes."""
+        scope: Optional[Scope] = self
+        while scope is not None and scope.kind != "function":
+            scope = scope.parent
+        return scope
+
+
+def selected_name(
+    node: LN, capture: Capture, key: Optional[str] = None
+) -> Optional[Leaf]:
+    """The NAME leaf a selector matched, or None if the match isn't a plain name
+    (eg, an attribute).
+
+    `key` names the selector's capture of the name, like `function_name`; without
+    it, the first capture ending in `_name` is used, other than `module_name`,
+    which holds the module of `from` imports rather than the selected name.
+    """
+    value = capture.get(key) if key else None
+    if key is None:
+        for name, captured in capture.items():
+            if name.endswith("_name") and name != "module_name":
+                value = captured
+                break
+    if isinstance(value, Leaf):
+        leaf = value
+    elif isinstance(node, Leaf):
+        leaf = node
+    else:
+        return None
+    if leaf.type != TOKEN.NAME:
+        return None
+    previous = leaf.prev_sibling
+    if previous is not None and previous.type == TOKEN.DOT:
+        return None  # attribute access
+    return leaf
+
+
+class SymbolTable:
+    """Scopes and bindings of a parsed tree.
+
+    Use `SymbolTable.of(node)` to get the table of the tree containing `node`,
+    which is built once per tree.  Like `TreeIndex`, the table describes the tree
+    as it was built: names are looked up by their original values, and nodes
+    added since belong to the scope of their nearest ancestor in the table.
+    """
+
+    def __init__(self, root: LN) -> None:
+        self.root = root
+        self.module = Scope("module", root)
+        self.scopes: List[Scope] = [self.module]
+        # id(leaf) -> (leaf, the scope it's in)
+        self.leaves: Dict[int, Tuple[Leaf, Scope]] = {}
+
+        self.stack: List[Tuple[LN, Scope]] = [(root, self.module)]
+        while self.stack:
+            node, scope = self.stack.pop()
+            if isinstance(node, Leaf):
+                self.leaves[id(node)] = (node, scope)
+            else:
+                self.visit(node, scope)
+        del self.stack
+
+    @classmethod
+    def of(cls, node: LN) -> "SymbolTable":
+        while node.parent is not None:
+            node = node.parent
+        table = getattr(node, "bowler_symbols", None)
+        if table is None:
+            table = cls(node)
+            node.bowler_symbols = table  # type: ignore
+        return table
+
+    # building
+
+    def new_scope(self, kind: str, node: LN, parent: Scope) -> Scope:
+        scope = Scope(kind, node, parent)
+        self.scopes.append(scope)
+        return scope
+
+    def bind(self, leaf: LN, scope: Scope, kind: str, **kwargs: str) -> None:
+        if leaf.type != TOKEN.NAME:
+            return
+        name = leaf.value
+        if name in scope.globals:
+            scope = self.module
+        elif name in scope.nonlocals and scope.parent is not None:
+            scope = scope.parent.function or scope
+        binding = Binding(name, leaf, kind, **kwargs)  # type: ignore
+        scope.bindings.setdefault(name, []).append(binding)
+
+    def bind_target(self, node: LN, scope: Scope, kind: str) -> None:
+        """Bind the names assigned to by an assignment target."""
+        if node.type == TOKEN.NAME:
+            self.bind(node, scope, kind)
+        elif node.type == SYMBOL.atom:
+            if node.children[0].type in (TOKEN.LPAR, TOKEN.LSQB):
+                for child in node.children[1:-1]:
+                    self.bind_target(child, scope, kind)
+        elif node.type == SYMBOL.star_expr:
+            self.bind_target(node.children[1], scope, kind)
+        elif node.type in (
+            SYMBOL.exprlist,
+            SYMBOL.testlist,
+            SYMBOL.testlist_gexp,
+            SYMBOL.testlist_star_expr,
+            SYMBOL.listmaker,
+        ):
+            for child in node.children:
+                if child.type != TOKEN.COMMA:
+                    self.bind_target(child, scope, kind)
+
+    def visit(self, node: LN, scope: Scope) -> None:
+        """Record the bindings made by a node, and queue its children with the
+        scopes they belong to."""
+        children = node.children
+        items: List[Tuple[LN, Scope]] = []
+
+        if node.type == SYMBOL.funcdef:
+            self.bind(children[1], scope, "def")
+            inner = self.new_scope("function", node, scope)
+            colon = self.colon(node)
+            items.extend((child, scope) for child in children[:2])
+            self.parameters(children[2].children, scope, inner, items)
+            items.extend((child, scope) for child in children[3:colon])
+            items.extend((child, inner) for child in children[colon:])
+
+        elif node.type == SYMBOL.classdef:
+            self.bind(children[1], scope, "class")
+            inner = self.new_scope("class", node, scope)
+            colon = self.colon(node)
+            items.extend((child, scope) for child in children[:colon])
+            items.extend((child, inner) for child in children[colon:])
+
+        elif node.type in (SYMBOL.lambdef, SYMBOL.old_lambdef):
+            inner = self.new_scope("lambda", node, scope)
+            colon = self.colon(node)
+            items.append((children[0], scope))
+            self.parameters(children[1:colon], scope, inner, items)
+            items.extend((child, inner) for child in children[colon:])
+
+        elif node.type in COMPREHENSIONS and any(
+            child.type == SYMBOL.comp_for for child in children
+        ):
+            # the first iterable is evaluated in the enclosing scope
+            inner = self.new_scope("comprehension", node, scope)
+            for child in children:
+                if child.type == SYMBOL.comp_for:
+                    self.comp_for(child, inner, scope, items)
+                else:
+                    items.append((child, inner))
+
+        elif node.type == SYMBOL.comp_for:
+            self.comp_for(node, scope, scope, items)
+
+        else:
+            if node.type == SYMBOL.expr_stmt:
+                self.expr_stmt(node, scope)
+            elif node.type == SYMBOL.for_stmt:
+                self.bind_target(children[1], scope, "for")
+            elif node.type == SYMBOL.with_item:
+                self.bind_target(children[2], scope, "with")
+            elif node.type == SYMBOL.except_clause and len(children) == 4:
+                self.bind_target(children[3], scope, "except")
+            elif node.type == SYMBOL.namedexpr_test:
+                # assignment expressions bind outside of comprehensions
+                target = scope
+                while target.kind == "comprehension" and target.parent:
+                    target = target.parent
+                self.bind(children[0], target, "assign")
+            elif node.type == SYMBOL.import_name:
+                self.import_name(children[1], scope)
+            elif node.type == SYMBOL.import_from:
+                self.import_from(node, scope)
+            elif node.type == SYMBOL.global_stmt:
+                names = {c.value for c in children[1:] if c.type == TOKEN.NAME}
+                if children[0].value == "global":
+                    scope.globals |= names
+                else:
+                    scope.nonlocals |= names
+            items.extend((child, scope) for child in children)
+
+        # in reverse, so that nodes are visited in source order
+        self.stack.extend(reversed(items))
+
+    @staticmethod
+    def colon(node: LN) -> int:
+        return next(i for i, c in enumerate(node.children) if c.type == TOKEN.COLON)
+
+    def parameters(
+        self,
+        nodes: List[LN],
+        outer: Scope,
+        inner: Scope,
+        items: List[Tuple[LN, Scope]],
+    ) -> None:
+        """Bind parameter names in the function's scope; defaults and
+        annotations belong to the enclosing scope."""
+        previous: Optional[LN] = None
+        for child in nodes:
+            if child.type == TOKEN.NAME and (
+                previous is None or previous.type != TOKEN.EQUAL
+            ):
+                self.bind(child, inner, "param")
+                items.append((child, inner))
+            elif child.type in (SYMBOL.tname, SYMBOL.vname):
+                self.bind(child.children[0], inner, "param")
+                items.append((child.children[0], inner))
+                items.extend((c, outer) for c in child.children[1:])
+            elif child.type in (
+                SYMBOL.typedargslist,
+                SYMBOL.varargslist,
+                SYMBOL.tfpdef,
+                SYMBOL.vfpdef,
+                SYMBOL.tfplist,
+                SYMBOL.vfplist,
+            ):
+                self.parameters(child.children, outer, inner, items)
+            else:
+                items.append((child, outer))
+            previous = child
+
+    def comp_for(
+        self, node: LN, inner: Scope, outer: Scope, items: List[Tuple[LN, Scope]]
+    ) -> None:
+        children = node.children
+        start = next(i for i, c in enumerate(children) if c.value == "for")
+        self.bind_target(children[start + 1], inner, "for")
+        for index, child in enumerate(children):
+            items.append((child, outer if index == start + 3 else inner))
+
+    def expr_stmt(self, node: LN, scope: Scope) -> None:
+        children = node.children
+        if children[1].type == TOKEN.EQUAL:
+            for child in children[:-1:2]:
+                self.bind_target(child, scope, "assign")
+        else:  # annotated or augmented assignment
+            self.bind_target(children[0], scope, "assign")
+
+    def import_name(self, node: LN, scope: Scope) -> None:
+        if node.type == SYMBOL.dotted_as_names:
+            for child in node.children[::2]:
+                self.import_name(child, scope)
+        elif node.type == SYMBOL.dotted_as_name:
+            module = str(node.children[0]).strip()
+            self.bind(node.children[2], scope, "import", module=module)
+        elif node.type == SYMBOL.dotted_name:
+            first = node.children[0]
+            self.bind(first, scope, "import", module=first.value)
+        else:
+            self.bind(node, scope, "import", module=node.value)
+
+    def import_from(self, node: LN, scope: Scope) -> None:
+        children = node.children
+        index = next(
+            i
+            for i, c in enumerate(children)
+            if c.type == TOKEN.NAME and c.value == "import"
+        )
+        module = "".join(str(c).strip() for c in children[1:index])
+        names = [
+            c for c in children[index + 1 :] if c.type not in (TOKEN.LPAR, TOKEN.RPAR)
+        ]
+        if names and names[0].type == SYMBOL.import_as_names:
+            names = names[0].children[::2]
+        for name in names:
+            if name.type == SYMBOL.import_as_name:
+                imported, alias = name.children[0].value, name.children[2]
+                self.bind(alias, scope, "import", module=module, imported=imported)
+            elif name.type == TOKEN.NAME:
+                self.bind(name, scope, "import", module=module, imported=name.value)
+
+    # queries
+
+    def scope(self, node: LN) -> Scope:
+        """The scope `node` belongs to: the scope of its first leaf."""
+        while True:
+            leaf = node
+            while not isinstance(leaf, Leaf) and leaf.children:
+                leaf = leaf.children[0]
+            entry = self.leaves.get(id(leaf))
+            if entry is not None and entry[0] is leaf:
+                return entry[1]
+            if node.parent is None:
+                return self.module
+            node = node.parent
+
+    def lookup(self, leaf: LN) -> Optional[Scope]:
+        """The scope a NAME leaf's name is bound in, or None if it isn't bound in
+        this file (like builtins)."""
+        if leaf.type != TOKEN.NAME:
+            return None
+        name = leaf.value
+        scope = self.scope(leaf)
+        if name in scope.globals:
+            return self.module if name in self.module.bindings else None
+
+        current: Optional[Scope] = scope
+        if name in scope.nonlocals:
+            current = scope.parent
+        while current is not None:
+            if current is scope or current.kind != "class":
+                if name in current.bindings:
+                    return current
+                if name in current.globals:
+                    return self.module if name in self.module.bindings else None
+            current = current.parent
+        return None
+
+    def bindings(self, leaf: LN) -> List[Binding]:
+        """Every binding of a NAME leaf's name in the scope it's bound in."""
+        scope = self.lookup(leaf)
+        if scope is None:
+            return []
+        return scope.bindings[leaf.value]
@@ -5,15 +5,27 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from .cache import (
+    ImportIndexTest,
+    NameIndexTest,
+    ParseCacheTest,
+    PatternCacheTest,
+    ResultCacheTest,
+)
+from .codegen import MatcherGeneratorTest, PatternCacheMatcherTest
 from .helpers import (
     DottedPartsTest,
     FilenameEndswithTest,
     PowerPartsTest,
     PrintSelectorPatternTest,
     PrintTreeTest,
+    ScopeMapTest,
+    TreeIndexTest,
 )
 from .lib import BowlerTestCaseTest
+from .planner import FilterPlanTest
 from .query import QueryTest
 from .smoke import SmokeTest
+from .symbols import SymbolTableTest
 from .tool import ToolTest
 from .type_inference import ExpressionTest, OpMinTypeTest
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+from unittest import mock
+
+import volatile
+from fissix import pygram
+
+from ..cache import (
+    ImportIndex,
+    NameIndex,
+    ParseCache,
+    PatternCache,
+    ResultCache,
+    decode_tree,
+    describe,
+    encode_tree,
+    source_imports,
+    source_tokens,
+)
+from ..query import Query
+from ..tool import BowlerTool
+from .lib import BowlerTestCase
+
+SOURCE = """\
+import os
+
+class Foo(object):
+    # comment
+    def bar(self, x=1):
+        return os.path.join(x, "y")  # trailing
+"""
+
+
+class ParseCacheTest(BowlerTestCase):
+    def test_roundtrip(self):
+        tree = self.parse_source(SOURCE)
+        copy = decode_tree(encode_tree(tree))
+        self.assertEqual(str(copy), SOURCE)
+        self.assertEqual(copy, tree)
+
+        leaves = [(leaf.lineno, leaf.column) for leaf in tree.leaves()]
+        copy_leaves = [(leaf.lineno, leaf.column) for leaf in copy.leaves()]
+        self.assertEqual(leaves, copy_leaves)
+
+    def test_get_put(self):
+        grammar = pygram.python_grammar_no_print_statement
+        with volatile.dir() as tmp:
+            cache = ParseCache(tmp)
+            key = cache.key(SOURCE, grammar)
+            self.assertIsNone(cache.get(key))
+
+            cache.put(key, self.parse_source(SOURCE))
+            self.assertEqual(str(cache.get(key)), SOURCE)
+
+            # grammar is part of the key
+            self.assertNotEqual(key, cache.key(SOURCE, pygram.python_grammar))
+
+            # corrupt entries are misses
+            with open(cache.entry(key), "wb") as f:
+                f.write(b"garbage")
+            self.assertIsNone(cache.get(key))
+
+    def test_evict(self):
+        grammar = pygram.python_grammar_no_print_statement
+        with volatile.dir() as tmp:
+            cache = ParseCache(tmp)
+            keys = []
+            for i in range(4):
+                source = f"x = {i}\n"
+                key = cache.key(source, grammar)
+                cache.put(key, self.parse_source(source))
+                os.utime(cache.entry(key), (i, i))
+                keys.append(key)
+
+            size = os.path.getsize(cache.entry(keys[0]))
+            pending = cache.entry(keys[0]).parent / ".tmpwriting"
+            pending.write_bytes(b"\0" * size * 10)
+            os.utime(pending, (0, 0))
+
+            cache.max_size = size * 2
+            self.assertEqual(cache.evict(), 2)
+            self.assertTrue(pending.exists())
+            self.assertIsNone(cache.get(keys[0]))
+            self.assertIsNone(cache.get(keys[1]))
+            self.assertIsNotNone(cache.get(keys[3]))
+
+    def test_query_uses_cache(self):
+        with volatile.dir() as tmp:
+            cache = ParseCache(os.path.join(tmp, "cache"))
+            target = os.path.join(tmp, "target.py")
+            with open(target, "w") as f:
+                f.write(SOURCE)
+
+            def run():
+                hunks = []
+                (
+                    Query(target)
+                    .select_method("bar")
+                    .rename("baz")
+                    .process(lambda filename, hunk: hunks.append(hunk))
+                    .silent(in_process=True, parse_cache=cache)
+                )
+                return hunks
+
+            with mock.patch("bowler.tool.BowlerTool.log_message") as log_message:
+                first = run()
+                log_message.assert_any_call(
+                    "Parse cache: %d hits, %d misses (%.0f%% hit rate)", 0, 1, 0
+                )
+
+            with mock.patch("bowler.tool.BowlerTool.log_message") as log_message:
+                second = run()
+                log_message.assert_any_call(
+                    "Parse cache: %d hits, %d misses (%.0f%% hit rate)", 1, 0, 100
+                )
+
+            self.assertEqual(first, second)
+            self.assertEqual(len(first), 1)
+
+
+class ResultCacheTest(BowlerTestCase):
+    def test_describe(self):
+        def make(value):
+            return lambda: value
+
+        self.assertEqual(describe(make("a")), describe(make("a")))
+        self.assertNotEqual(describe(make("a")), describe(make("b")))
+        self.assertNotEqual(describe([make("a")]), describe([make("a"), make("a")]))
+        self.assertEqual(describe(make(object())), describe(make(object())))
+
+    def test_fingerprint(self):
+        def fingerprint(query):
+            return query.fingerprint(query.compile())
+
+        self.assertEqual(
+            fingerprint(Query().select_function("foo").rename("bar")),
+            fingerprint(Query().select_function("foo").rename("bar")),
+        )
+        self.assertNotEqual(
+            fingerprint(Query().select_function("foo").rename("bar")),
+            fingerprint(Query().select_function("foo").rename("baz")),
+        )
+        self.assertNotEqual(
+            fingerprint(Query().select_function("foo").rename("bar")),
+            fingerprint(Query().select_method("foo").rename("bar")),
+        )
+
+    def test_fingerprint_across_processes(self):
+        script = (
+            "from bowler import Query\n"
+            "query = Query().select_function('foo').add_argument('x', '1')\n"
+            "query.select_function('bar').modify_argument('y', 'z')\n"
+            "query.select_attribute('baz').in_class('C').encapsulate()\n"
+            "print(query.fingerprint(query.compile()))\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        env = dict(os.environ, PYTHONPATH=root, BOWLER_NO_PATTERN_CACHE="1")
+        fingerprints = {
+            subprocess.check_output([sys.executable, "-c", script], env=env)
+            for _ in range(2)
+        }
+        self.assertEqual(len(fingerprints), 1)
+
+    def test_get_update_save(self):
+        with volatile.dir() as tmp:
+            target = os.path.join(tmp, "target.py")
+            with open(target, "w") as f:
+                f.write(SOURCE)
+            digest = ResultCache.digest(target)
+            self.assertIsNone(ResultCache.digest(os.path.join(tmp, "missing.py")))
+
+            cache = ResultCache("query", tmp)
+            self.assertIsNone(cache.get(target, digest))
+            cache.update({target: (digest, [["hunk"]])})
+            cache.save()
+
+            cache = ResultCache("query", tmp)
+            self.assertEqual(cache.get(target, digest), [["hunk"]])
+            self.assertIsNone(cache.get(target, "other"))
+            self.assertIsNone(ResultCache("other", tmp).get(target, digest))
+
+            os.unlink(target)
+            cache.update({})
+            self.assertEqual(cache.records, {})
+
+    def test_incremental_query(self):
+        with volatile.dir() as tmp:
+            target = os.path.join(tmp, "target.py")
+            other = os.path.join(tmp, "other.py")
+            with open(target, "w") as f:
+                f.write(SOURCE)
+            with open(other, "w") as f:
+                f.write("def bar():\n    pass\n")
+
+            def run():
+                hunks = []
+                refactored = []
+                refactor_string = BowlerTool.refactor_string
+
+                def spy(tool, data, name):
+                    refactored.append(name)
+                    return refactor_string(tool, data, name)
+
+                with mock.patch("bowler.cache.CACHE_DIR", Path(tmp) / "cache"):
+                    with mock.patch.object(BowlerTool, "refactor_string", spy):
+                        (
+                            Query(tmp)
+                            .select_function("bar")
+                            .rename("baz")
+                            .process(lambda filename, hunk: hunks.append(hunk))
+                            .silent(in_process=True, incremental=True)
+                        )
+                return sorted(hunks), sorted(refactored)
+
+            first, refactored = run()
+            self.assertEqual(len(first), 2)
+            self.assertEqual(refactored, [other, target])
+
+            second, refactored = run()
+            self.assertEqual(first, second)
+            self.assertEqual(refactored, [])
+
+            with open(other, "w") as f:
+                f.write("def foo():\n    bar()\n")
+            third, refactored = run()
+            self.assertEqual(refactored, [other])
+            self.assertEqual(len(third), 2)
+            self.assertNotEqual(first, third)
+
+
+class PatternCacheTest(BowlerTestCase):
+    PATTERN = "power< 'foo' trailer< '(' args=any* ')' > >"
+
+    def test_memoized(self):
+        cache = PatternCache(None)
+        pattern, tree = cache.compile(self.PATTERN)
+        self.assertIs(cache.compile(self.PATTERN)[0], pattern)
+
+        node = self.parse_line("foo(1, 2)")
+        results = {}
+        self.assertTrue(pattern.match(node, results))
+        self.assertEqual(str(results["args"][0]), "1, 2")
+
+    def test_on_disk(self):
+        with volatile.dir() as tmp:
+            pattern, _ = PatternCache(tmp).compile(self.PATTERN)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            with mock.patch("bowler.cache.PatternCompiler") as compiler:
+                cached, tree = PatternCache(tmp).compile(self.PATTERN)
+                compiler.assert_not_called()
+            self.assertIsNot(cached, pattern)
+            self.assertIsNotNone(tree)
+            self.assertTrue(cached.match(self.parse_line("foo(1, 2)")))
+            self.assertFalse(cached.match(self.parse_line("bar(1, 2)")))
+
+            # unreadable entries are compiled again
+            entry = PatternCache(tmp).entry(self.PATTERN)
+            entry.write_bytes(b"garbage")
+            self.assertTrue(PatternCache(tmp).compile(self.PATTERN)[0])
+
+    def test_disabled(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        env = dict(os.environ, PYTHONPATH=root, BOWLER_NO_PATTERN_CACHE="1")
+        script = "from bowler.cache import PATTERNS; print(PATTERNS.path)"
+        output = subprocess.check_output([sys.executable, "-c", script], env=env)
+        self.assertEqual(output.strip(), b"None")
+
+    def test_entry_versions(self):
+        cache = PatternCache("/cache")
+        entry = cache.entry(self.PATTERN)
+        self.assertEqual(cache.entry(self.PATTERN), entry)
+        with mock.patch("bowler.__version__", "0.0.0-other"):
+            self.assertNotEqual(cache.entry(self.PATTERN), entry)
+        with mock.patch("bowler.cache.fissix_version", "0.0.0-other"):
+            self.assertNotEqual(cache.entry(self.PATTERN), entry)
+
+    def test_evict(self):
+        with volatile.dir() as tmp:
+            cache = PatternCache(tmp, max_entries=2)
+            for name in ("a", "b", "c"):
+                cache.compile(f"power< '{name}' any* >")
+            self.assertEqual(len(os.listdir(tmp)), 2)
+
+    def test_query_fixers(self):
+        with mock.patch("bowler.query.PATTERNS", PatternCache(None)) as patterns:
+            fixers = Query().select_function("foo").compile()
+            fixer = fixers[0]({}, [])
+            self.assertIs(fixer.pattern, patterns.patterns[fixer.PATTERN][0])
+
+
+class ImportIndexTest(BowlerTestCase):
+    def test_source_imports(self):
+        source = b"""\
+import os.path, sys as system
+from a.b import c, d as e
+from . import sibling
+from .pkg import module
+from star import *
+
+def f():
+    import json
+"""
+        self.assertEqual(
+            source_imports(source),
+            ["a.b", "a.b.c", "a.b.d", "json", "os.path", "star", "sys"],
+        )
+        self.assertIsNone(source_imports(b"print 'hello'\n"))
+
+    def test_update_save(self):
+        with volatile.dir() as tmp:
+            path = os.path.join(tmp, "index.json")
+            target = os.path.join(tmp, "target.py")
+            other = os.path.join(tmp, "other.py")
+            with open(target, "w") as f:
+                f.write("import os.path\n")
+            with open(other, "w") as f:
+                f.write("from a.b import c\n")
+
+            index = ImportIndex(path)
+            self.assertEqual(index.update([tmp]), 2)
+            self.assertEqual(index.update([tmp]), 0)
+            index.save()
+
+            index = ImportIndex(path)
+            self.assertEqual(index.imports(target), ["os.path"])
+            with open(target, "w") as f:
+                f.write("import sys, json\n")
+            self.assertEqual(index.update([tmp]), 1)
+            self.assertEqual(index.imports(target), ["json", "sys"])
+
+            os.unlink(other)
+            self.assertEqual(index.update([tmp]), 0)
+            self.assertEqual(list(index.records), [target])
+
+    def test_might_import(self):
+        with volatile.dir() as tmp:
+            target = os.path.join(tmp, "target.py")
+            with open(target, "w") as f:
+                f.write("import a.b\nfrom c import d\n")
+            index = ImportIndex(os.path.join(tmp, "index.json"))
+            self.assertTrue(index.might_import(target, ["a.b"]))
+            self.assertTrue(index.might_import(target, ["a"]))
+            self.assertTrue(index.might_import(target, ["a.b.c"]))
+            self.assertTrue(index.might_import(target, ["c.d"]))
+            self.assertTrue(index.might_import(target, ["x", "c"]))
+            self.assertFalse(index.might_import(target, ["ab"]))
+            self.assertFalse(index.might_import(target, ["d"]))
+
+            with open(target, "w") as f:
+                f.write("print 'python 2'\n")
+            self.assertTrue(index.might_import(target, ["anything"]))
+
+    def test_query_import_index(self):
+        with volatile.dir() as tmp:
+            files = {
+                "uses.py": "import foo.bar\nfoo.bar.baz()\n",
+                "parent.py": "import foo\nfoo.bar.baz()\n",
+                "unrelated.py": "import os\nfoo = 1\n",
+            }
+            for name, source in files.items():
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write(source)
+            index = ImportIndex(os.path.join(tmp, "index.json"))
+
+            refactored = []
+            refactor_string = BowlerTool.refactor_string
+
+            def spy(tool, data, name):
+                refactored.append(os.path.basename(name))
+                return refactor_string(tool, data, name)
+
+            with mock.patch.object(BowlerTool, "refactor_string", spy):
+                query = (
+                    Query(tmp)
+                    .select_module("foo.bar")
+                    .rename("qux.bar")
+                    .silent(in_process=True, import_index=index)
+                )
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(sorted(refactored), ["parent.py", "uses.py"])
+            self.assertTrue(os.path.exists(index.path))
+
+            # other selectors ignore the index
+            refactored.clear()
+            with mock.patch.object(BowlerTool, "refactor_string", spy):
+                Query(tmp).select_var("foo").silent(in_process=True, import_index=index)
+            self.assertEqual(len(refactored), 3)
+
+
+class NameIndexTest(BowlerTestCase):
+    def write(self, filename, source):
+        with open(filename, "w") as f:
+            f.write(source)
+
+    def test_source_tokens(self):
+        source = b"""\
+# foo in a comment
+def bar(baz):
+    print "foo", baz
+"""
+        self.assertEqual(
+            source_tokens(source), {("bar", 2), ("baz", 2), ("print", 3), ("baz", 3)}
+        )
+        self.assertIsNone(source_tokens(b"x = '''\n"))
+
+    def test_refresh(self):
+        with volatile.dir() as tmp:
+            path = os.path.join(tmp, "names.sqlite")
+            target = os.path.join(tmp, "target.py")
+            other = os.path.join(tmp, "other.py")
+            self.write(target, "def foo():\n    return bar\n")
+            self.write(other, "foo = '''\n")
+
+            index = NameIndex(path)
+            self.assertEqual(index.update([tmp]), 2)
+            self.assertEqual(index.update([tmp]), 0)
+            index.save()
+
+            index = NameIndex(path)
+            self.assertEqual(index.occurrences("foo"), [(target, 1)])
+            self.assertEqual(index.occurrences("bar"), [(target, 2)])
+            # touched but unchanged files aren't tokenized again
+            os.utime(target, ns=(0, 0))
+            self.assertEqual(index.update([tmp]), 0)
+            self.write(target, "bar = 1\nfoo(bar)\n")
+            self.assertEqual(index.update([tmp]), 1)
+            self.assertEqual(index.occurrences("bar"), [(target, 1), (target, 2)])
+
+            os.unlink(other)
+            os.unlink(target)
+            self.assertEqual(index.update([tmp]), 0)
+            self.assertEqual(index.occurrences("foo"), [])
+
+            # unreadable indexes start over
+            index.db.close()
+            with open(path, "wb") as f:
+                f.write(b"garbage" * 1000)
+            self.assertEqual(NameIndex(path).occurrences("foo"), [])
+
+    def test_might_contain(self):
+        with volatile.dir() as tmp:
+            target = os.path.join(tmp, "target.py")
+            self.write(target, "def foo(bar):\n    return 'baz'  # qux\n")
+            index = NameIndex(os.path.join(tmp, "names.sqlite"))
+            self.assertTrue(index.might_contain(target, [["foo", "bar"]]))
+            self.assertTrue(index.might_contain(target, [["baz"], ["def", "foo"]]))
+            self.assertFalse(index.might_contain(target, [["baz"], ["qux"]]))
+            self.assertFalse(index.might_contain(target, [["foo", "baz"]]))
+
+            self.write(target, "x = '''\n")
+            self.assertTrue(index.might_contain(target, [["anything"]]))
+            self.assertTrue(index.might_contain(os.path.join(tmp, "missing.py"), []))
+
+    def test_query_name_index(self):
+        with volatile.dir() as tmp:
+            files = {
+                "calls.py": "def foo():\n    pass\n",
+                "strings.py": "x = 'foo()'  # foo\n",
+                "unrelated.py": "bar = 1\n",
+            }
+            for name, source in files.items():
+                self.write(os.path.join(tmp, name), source)
+            index = NameIndex(os.path.join(tmp, "names.sqlite"))
+
+            refactored = []
+            refactor_file = BowlerTool.refactor_file
+
+            def spy(tool, filename, *args, **kwargs):
+                refactored.append(os.path.basename(filename))
+                return refactor_file(tool, filename, *args, **kwargs)
+
+            hunks = []
+            with mock.patch.object(BowlerTool, "refactor_file", spy):
+                query = (
+                    Query(tmp)
+                    .select_function("foo")
+                    .rename("bar")
+                    .process(lambda filename, hunk: hunks.append(hunk))
+                    .silent(in_process=True, name_index=index)
+                )
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(refactored, ["calls.py"])
+            self.assertEqual(len(hunks), 1)
+
+            refactored.clear()
+            with mock.patch.object(BowlerTool, "refactor_file", spy):
+                query = (
+                    Query(tmp)
+                    .select_function("foo")
+                    .rename("bar")
+                    .silent(in_process=True, name_index=False)
+                )
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(len(refactored), 3)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+from unittest import mock
+
+import volatile
+
+from ..cache import PatternCache
+from ..codegen import generate_matcher, required_names
+from ..query import Query
+from .lib import BowlerTestCase
+
+SOURCE = """\
+import os
+import os.path as osp
+from foo.bar import baz, qux as quux
+
+class Foo(Base, metaclass=Meta):
+    x = 1
+
+    def bar(self, a, *args, b=2, **kwargs):
+        x = os.path.join(a, "b")
+        self.items.append(baz(x)[0].value)
+        return osp.join(*args, **kwargs)
+
+def baz(y):
+    print(y, Foo().bar(1))
+"""
+
+
+class MatcherGeneratorTest(BowlerTestCase):
+    def generate(self, pattern):
+        source, fallbacks = generate_matcher(pattern)
+        namespace = {"P": fallbacks}
+        exec(source, namespace)
+        return namespace["match"], fallbacks
+
+    def assertAgrees(self, pattern_text, source=SOURCE):
+        pattern, _ = PatternCache(None).compile(pattern_text)
+        match, _ = self.generate(pattern)
+        tree = self.parse_source(source)
+        matched = 0
+        for node in tree.pre_order():
+            expected, results = {}, {}
+            found = bool(pattern.match(node, expected))
+            self.assertEqual(found, bool(match(node, results)))
+            self.assertEqual(list(expected.items()), list(results.items()))
+            matched += found
+        return matched
+
+    def test_selectors(self):
+        queries = [
+            Query().select_root(),
+            Query().select_module("os.path"),
+            Query().select_class("Foo"),
+            Query().select_subclass("Base"),
+            Query().select_attribute("append"),
+            Query().select_method("join"),
+            Query().select_function("baz"),
+            Query().select_function("os.path.join"),
+            Query().select_var("x"),
+        ]
+        for query in queries:
+            for fixer in query.compile():
+                with self.subTest(pattern=fixer.PATTERN):
+                    self.assertAgrees(fixer.PATTERN)
+
+    def test_positional(self):
+        pattern, _ = PatternCache(None).compile(
+            "power< name='os' trailer< '.' 'path' > rest=any* >"
+        )
+        source, fallbacks = generate_matcher(pattern)
+        self.assertEqual(fallbacks, [])
+        self.assertNotIn("for ", source)
+        self.assertEqual(
+            self.assertAgrees("power< name='os' trailer< '.' 'path' > rest=any* >"), 1
+        )
+
+    def test_fallback(self):
+        # two wildcards among the same children need fissix's backtracking
+        text = "typedargslist< any* '*' x=NAME any* >"
+        pattern, _ = PatternCache(None).compile(text)
+        _, fallbacks = self.generate(pattern)
+        self.assertEqual(fallbacks, [pattern])
+        self.assertEqual(self.assertAgrees(text), 1)
+
+    def test_alternatives(self):
+        text = "( import_name< 'import' any > | import_from< 'from' mod=any any* > )"
+        self.assertEqual(self.assertAgrees(text), 3)
+
+    def test_failed_match_leaves_results(self):
+        pattern, _ = PatternCache(None).compile("expr_stmt< x=NAME '=' '2' >")
+        match, _ = self.generate(pattern)
+        results = {}
+        self.assertFalse(match(self.parse_line("x = 1"), results))
+        self.assertEqual(results, {})
+
+    def test_required_names(self):
+        def names(text):
+            return required_names(PatternCache(None).compile(text)[0])
+
+        self.assertEqual(names("power< 'foo' trailer< '(' any* ')' > >"), {"foo"})
+        self.assertEqual(names("power< ( 'a' 'b' | 'b' 'c' ) any* >"), {"b"})
+        self.assertEqual(names("power< ['a'] 'b' 'c'* >"), {"b"})
+        self.assertEqual(names("import_from< 'from' ( 'x' | any ) any* >"), {"from"})
+        self.assertEqual(names("power< '_private' any* >"), {"_private"})
+        self.assertEqual(names("any< '(' any* ')' >"), set())
+        self.assertEqual(names("power< (not 'foo') any* >"), set())
+
+        pattern = PatternCache(None).compile(
+            Query().select_function("foo").compile()[0].PATTERN
+        )[0]
+        self.assertEqual(required_names(pattern), {"foo"})
+
+
+class PatternCacheMatcherTest(BowlerTestCase):
+    PATTERN = "power< 'foo' trailer< '(' args=any* ')' > >"
+
+    def test_on_disk(self):
+        with volatile.dir() as tmp:
+            PatternCache(tmp).matcher(self.PATTERN)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            with mock.patch("bowler.cache.generate_matcher") as generate:
+                match = PatternCache(tmp).matcher(self.PATTERN)
+                generate.assert_not_called()
+            results = {}
+            self.assertTrue(match(self.parse_line("foo(1, 2)"), results))
+            self.assertEqual(str(results["args"][0]), "1, 2")
+            self.assertFalse(match(self.parse_line("bar(1, 2)"), {}))
+
+    def test_query_fixers(self):
+        with mock.patch("bowler.query.PATTERNS", PatternCache(None)) as patterns:
+            fixer = Query().select_function("foo").compile()[0]({}, [])
+            self.assertIs(fixer.matcher, patterns.matchers[fixer.PATTERN])
+            node = self.parse_line("foo(1)")
+            self.assertEqual(fixer.match(node)["node"], node)
+            self.assertFalse(fixer.match(self.parse_line("bar(1)")))
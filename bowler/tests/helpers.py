@@ -10,12 +10,15 @@ import unittest
 from fissix.pytree import Leaf, Node
 
 from ..helpers import (
+    ScopeMap,
+    TreeIndex,
     dotted_parts,
     filename_endswith,
     power_parts,
     print_selector_pattern,
     print_tree,
 )
+from ..types import SYMBOL, TOKEN
 from .lib import BowlerTestCase
 
 
@@ -123,3 +126,78 @@ class FilenameEndswithTest(unittest.TestCase):
         self.assertTrue(py("foo/foo.pyi"))
         self.assertFalse(py("foo.txt"))
         self.assertFalse(py("foo/foo.txt"))
+
+
+class TreeIndexTest(BowlerTestCase):
+    def test_tree_index(self):
+        node = self.parse_line("foo(bar.foo, baz(foo))")
+        tree = node.parent.parent
+        index = TreeIndex.of(node)
+        self.assertIs(index, TreeIndex.of(tree))
+        self.assertIs(index.root, tree)
+
+        self.assertEqual(index.post_order, list(tree.post_order()))
+        self.assertEqual(
+            [str(n) for n in index.nodes(SYMBOL.power)],
+            ["bar.foo", " baz(foo)", "foo(bar.foo, baz(foo))"],
+        )
+        self.assertEqual(len(index.leaves("foo")), 3)
+        self.assertEqual(index.leaves("missing"), [])
+        self.assertEqual(
+            [str(n) for n in index.containing("baz", {SYMBOL.power, SYMBOL.arglist})],
+            [" baz(foo)", "bar.foo, baz(foo)", "foo(bar.foo, baz(foo))"],
+        )
+
+    def test_tree_index_removed_nodes(self):
+        node = self.parse_line("foo(bar.foo, baz(foo))")
+        index = TreeIndex.of(node)
+        arglist = node.children[1].children[1]
+        arglist.remove()
+        self.assertFalse(index.attached(arglist))
+        self.assertEqual([n.value for n in index.leaves("foo")], ["foo"])
+        self.assertEqual(index.nodes(TOKEN.COMMA), [])
+
+
+class ScopeMapTest(BowlerTestCase):
+    SOURCE = """\
+class Foo(Base, metaclass=Meta):
+    x = 1
+
+    def bar(self):
+        return x
+
+def baz():
+    class Inner:
+        pass
+"""
+
+    def test_scope_map(self):
+        tree = self.parse_source(self.SOURCE)
+        leaves = {leaf.value: leaf for leaf in tree.leaves()}
+        scopes = ScopeMap.of(leaves["return"])
+        self.assertIs(scopes, ScopeMap.of(tree))
+
+        foo = tree.children[0]
+        bar = leaves["bar"].parent
+        inner = leaves["Inner"].parent
+        self.assertEqual(scopes.lookup(leaves["return"]), (foo, bar))
+        self.assertEqual(scopes.lookup(leaves["Meta"]), (foo, None))
+        self.assertEqual(scopes.lookup(foo), (foo, None))
+        self.assertEqual(scopes.enclosing_class(leaves["pass"]), inner)
+        self.assertEqual(scopes.enclosing_function(inner), tree.children[1])
+        self.assertEqual(scopes.lookup(tree), (None, None))
+
+        self.assertEqual(
+            scopes.bases(foo), {"class", "Foo", "Base", "metaclass", "Meta"}
+        )
+        self.assertEqual(scopes.bases(inner), {"class", "Inner"})
+
+    def test_scope_map_added_nodes(self):
+        tree = self.parse_source(self.SOURCE)
+        foo = tree.children[0]
+        scopes = ScopeMap.of(foo)
+        stmt = foo.children[-1].children[2]  # x = 1
+        new = Node(SYMBOL.expr_stmt, [Leaf(TOKEN.NAME, "y"), Leaf(TOKEN.EQUAL, "=")])
+        stmt.children[0].replace(new)
+        self.assertIs(ScopeMap.of(new.children[0]), scopes)
+        self.assertEqual(scopes.lookup(new.children[0]), (foo, None))
@@ -7,9 +7,13 @@
 
 import functools
 import multiprocessing
+import queue
 import sys
+import tempfile
 import unittest
 from io import StringIO
+from pathlib import Path
+from unittest import mock
 
 import click
 import volatile
@@ -17,13 +21,30 @@ from fissix import pygram, pytree
 from fissix.pgen2.driver import Driver
 
 from bowler import Query
+from bowler.cache import PatternCache
 from bowler.types import LN, SYMBOL, TOKEN
 
 
+def isolate_caches(test: unittest.TestCase) -> None:
+    """Keep the on-disk caches a test uses in a temporary directory, rather than
+    in the user's home directory."""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    patterns = PatternCache(Path(tmp.name) / "patterns")
+    for patcher in (
+        mock.patch("bowler.cache.CACHE_DIR", Path(tmp.name)),
+        mock.patch("bowler.cache.PATTERNS", patterns),
+        mock.patch("bowler.query.PATTERNS", patterns),
+    ):
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
 class BowlerTestCase(unittest.TestCase):
     """Subclass of TestCase that captures stdout and makes it easier to run Bowler."""
 
     def setUp(self):
+        isolate_caches(self)
         self.buffer = StringIO()
         # Replace the write method instead of stdout so that already-existing
         # loggers end up writing here.
@@ -67,7 +88,9 @@ class BowlerTestCase(unittest.TestCase):
         if not (modifier or modifier_func or query_func):
             raise ValueError("Pass modifier")
 
-        exception_queue = multiprocessing.Queue()
+        # Modifiers run synchronously when in_process=True, while the feeder
+        # thread behind a multiprocessing.Queue would publish asynchronously.
+        exception_queue = queue.Queue() if in_process else multiprocessing.Queue()
 
         def store_exceptions_on(func):
             @functools.wraps(func)
@@ -142,11 +165,14 @@ class BowlerTestCase(unittest.TestCase):
                 )
                 self.assertMultiLineEqual(expected, output)
 
-    def parse_line(self, source: str) -> LN:
+    def parse_source(self, source: str) -> LN:
         grammar = pygram.python_grammar_no_print_statement
         driver = Driver(grammar, convert=pytree.convert)
+        return driver.parse_string(source)
+
+    def parse_line(self, source: str) -> LN:
         # Skip file_input, simple_stmt
-        return driver.parse_string(source + "\n").children[0].children[0]
+        return self.parse_source(source + "\n").children[0].children[0]
 
 
 class BowlerTestCaseTest(BowlerTestCase):
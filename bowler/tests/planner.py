@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+from unittest import mock
+
+import volatile
+
+from ..planner import FilterPlan, constant_cost
+from ..query import Query
+from .lib import BowlerTestCase
+
+
+class FilterPlanTest(BowlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = 0.0
+        self.calls = []
+
+    def make_filter(self, name, cost, passes):
+        def filter(node, capture, filename):
+            self.calls.append(name)
+            self.clock += cost
+            return passes(capture)
+
+        filter.__name__ = name
+        return filter
+
+    def test_evaluation(self):
+        plan = FilterPlan(
+            [
+                self.make_filter("a", 0, lambda c: c["a"]),
+                self.make_filter("b", 0, lambda c: c["b"]),
+            ]
+        )
+        self.assertTrue(plan(None, {"a": True, "b": True}, "f"))
+        self.assertFalse(plan(None, {"a": False, "b": True}, "f"))
+        self.assertFalse(plan(None, {"a": True, "b": False}, "f"))
+        self.assertEqual(self.calls, ["a", "b", "a", "a", "b"])
+        self.assertEqual([(s.calls, s.passed) for s in plan.stats], [(3, 2), (2, 1)])
+        self.assertTrue(FilterPlan([])(None, {}, "f"))
+
+    def test_adaptive(self):
+        def run(adaptive):
+            plan = FilterPlan(
+                [
+                    self.make_filter("expensive", 1.0, lambda c: True),
+                    self.make_filter("selective", 0.01, lambda c: c["i"] % 2),
+                    constant_cost(self.make_filter("constant", 0, lambda c: True)),
+                ],
+                adaptive=adaptive,
+            )
+            with mock.patch("time.perf_counter", lambda: self.clock):
+                for i in range(200):
+                    plan(None, {"i": i}, "f")
+            return plan
+
+        plan = run(adaptive=False)
+        self.assertEqual(
+            [s.name for s in plan.order], ["expensive", "selective", "constant"]
+        )
+        self.assertEqual(plan.stats[0].calls, 200)
+
+        plan = run(adaptive=True)
+        self.assertEqual(
+            [s.name for s in plan.order], ["constant", "selective", "expensive"]
+        )
+        self.assertLess(plan.stats[0].calls, 200)
+        self.assertEqual(plan.stats[1].calls, 200)
+        self.assertEqual(plan.stats[2].seconds, 0.0)
+
+        lines = plan.report()
+        self.assertRegex(lines[0], r"^constant: \d+ calls, 100% passed$")
+        self.assertTrue(lines[1].startswith("selective: 200 calls, 50% passed, "))
+
+    def test_query_reorder_filters(self):
+        with volatile.dir() as tmp:
+            target = os.path.join(tmp, "target.py")
+            with open(target, "w") as f:
+                f.write("x = 1\n" + "print(x)\n" * 99)
+
+            def run(**kwargs):
+                calls = []
+                (
+                    Query(target)
+                    .select_var("x")
+                    .filter(lambda node, capture, filename: not calls.append(node))
+                    .is_def()
+                    .rename("y")
+                    .silent(in_process=True, **kwargs)
+                )
+                return len(calls)
+
+            self.assertGreaterEqual(run(), 100)
+            self.assertLess(run(reorder_filters=True), FilterPlan.REPLAN_INTERVAL)
+
+    def test_summary_labels(self):
+        with volatile.dir() as tmp:
+            target = os.path.join(tmp, "target.py")
+            with open(target, "w") as f:
+                f.write("x = 1\nprint(x)\n")
+
+            with self.assertLogs("RefactoringTool", "DEBUG") as logs:
+                (
+                    Query(target)
+                    .select_var("x")
+                    .is_def()
+                    .select_function("print")
+                    .filter(lambda node, capture, filename: True)
+                    .silent(in_process=True)
+                )
+
+            headers = [line for line in logs.output if "Filters for" in line]
+            self.assertEqual(
+                headers,
+                [
+                    "DEBUG:RefactoringTool:Filters for Fixer 0 (select_var):",
+                    "DEBUG:RefactoringTool:Filters for Fixer 1 (select_function):",
+                ],
+            )
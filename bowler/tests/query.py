@@ -5,9 +5,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 from unittest import mock
 
-from ..query import SELECTORS, Query
+import volatile
+
+from ..query import SELECTORS, Query, required_literals
+from ..tool import BowlerTool
 from ..types import TOKEN, Leaf
 from .lib import BowlerTestCase
 
@@ -343,3 +347,220 @@ class Bar:
             self.assertIn(
                 "Only the last fixer/callback may return", error.call_args[0][0]
             )
+
+    def test_filter_scopes(self):
+        source = """\
+import foo as f
+from bar.baz import g
+
+x = 1
+
+def outer(x):
+    def inner():
+        return f(x) + g(x)
+    return len(x)
+"""
+
+        def run(modifier):
+            query_func = lambda x: modifier(Query(x).select_var("x"))
+            return self.run_bowler_modifier(source, query_func=query_func).count("y")
+
+        self.assertEqual(run(lambda q: q.rename("y")), 5)
+        self.assertEqual(run(lambda q: q.is_local().rename("y")), 4)
+        self.assertEqual(run(lambda q: q.is_global().rename("y")), 1)
+        self.assertEqual(run(lambda q: q.in_function().rename("y")), 4)
+        self.assertEqual(run(lambda q: q.in_function("inner").rename("y")), 2)
+
+        def run_import(name, module):
+            def query_func(x):
+                query = Query(x).select_var(name).binds_to_import(module)
+                return query.rename("h")
+
+            return self.run_bowler_modifier(source, query_func=query_func)
+
+        self.assertEqual(run_import("f", None).count("h"), 2)
+        self.assertEqual(run_import("f", "foo").count("h"), 2)
+        self.assertEqual(run_import("g", "bar").count("h"), 2)
+        self.assertEqual(run_import("g", "bar.baz").count("h"), 2)
+        self.assertEqual(run_import("g", "ba").count("h"), 0)
+        self.assertEqual(run_import("x", None).count("h"), 0)
+
+    def test_filter_scopes_on_imports(self):
+        source = """\
+from foo import f, C
+
+def g():
+    return f(C())
+"""
+
+        def run(modifier):
+            return self.run_bowler_modifier(
+                source, query_func=lambda x: modifier(Query(x))
+            )
+
+        renamed = """\
+from foo import h, C
+
+def g():
+    return h(C())"""
+        self.assertEqual(
+            run(lambda q: q.select_function("f").binds_to_import("foo").rename("h")),
+            renamed,
+        )
+        self.assertEqual(
+            run(lambda q: q.select_function("f").is_global().rename("h")), renamed
+        )
+        self.assertEqual(
+            run(lambda q: q.select_class("C").binds_to_import("foo").rename("D")),
+            renamed.replace("h", "f").replace("C", "D"),
+        )
+        self.assertEqual(
+            run(lambda q: q.select_function("f").binds_to_import("bar").rename("h")),
+            source.rstrip(),
+        )
+
+    def test_required_literals(self):
+        query = Query().select_module("a.b").select_function("foo").select_root()
+        fixers = query.compile()
+        self.assertEqual(fixers[0].LITERALS, ["a", "b"])
+        self.assertEqual(fixers[1].LITERALS, ["foo"])
+        self.assertIsNone(fixers[2].LITERALS)
+        self.assertIsNone(required_literals(Query().select("'foo'").current))
+
+        # names every match of the pattern contains
+        query = Query().select("power< 'foo' trailer< '(' any* ')' > >")
+        query.select_subclass("Base").select("funcdef< any* >")
+        fixers = query.compile()
+        self.assertEqual(fixers[0].LITERALS, ["foo"])
+        self.assertEqual(fixers[1].LITERALS, ["Base", "class"])
+        self.assertIsNone(fixers[2].LITERALS)
+
+    def test_literal_prefilter(self):
+        def query_func(arg):
+            return Query(arg).select_function("foo").rename("bar")
+
+        with mock.patch("bowler.tool.BowlerTool.refactor_string") as refactor_string:
+            output = self.run_bowler_modifier("def baz(): pass", query_func=query_func)
+            self.assertEqual("def baz(): pass", output)
+            refactor_string.assert_not_called()
+
+        # substring hits still parse and match normally
+        self.run_bowler_modifiers(
+            [
+                ("def foo_(): pass\nfoo()", "def foo_(): pass\nbar()"),
+                ("foo_()", "foo_()"),
+            ],
+            query_func=query_func,
+        )
+
+    def test_bottom_matcher(self):
+        fixers = Query().select_function("foo").compile()
+        self.assertTrue(fixers[0].BM_compatible)
+        fixers = Query().select_pattern("power< 'foo' any* >").compile()
+        self.assertFalse(fixers[0].BM_compatible)
+        fixers = Query().select_function("foo").select_class("Foo").compile()
+        self.assertFalse(any(fixer.BM_compatible for fixer in fixers))
+
+        # each matched node is only passed to callbacks once
+        matched = []
+
+        def query_func(arg):
+            return (
+                Query(arg)
+                .select_class("object")
+                .modify(lambda node, capture, filename: matched.append(node))
+            )
+
+        self.run_bowler_modifier(
+            "class Foo(object):\n    x = object()\n", query_func=query_func
+        )
+        self.assertEqual(
+            [str(node).strip() for node in matched],
+            ["object()", "class Foo(object):\n    x = object()"],
+        )
+
+    def test_untouched_tree_not_serialized(self):
+        def query_func(arg):
+            return (
+                Query(arg)
+                .select_function("foo")
+                .filter(lambda node, capture, filename: False)
+                .rename("bar")
+            )
+
+        with mock.patch("bowler.tool.BowlerTool.processed_file") as processed_file:
+            processed_file.return_value = []
+            self.run_bowler_modifier("def foo(): pass", query_func=query_func)
+            new_text, filename, old_text = processed_file.call_args[0]
+            self.assertIs(new_text, old_text)
+
+    def test_leaf_edits_mark_tree_changed(self):
+        def modifier(node, capture, filename):
+            capture["function_name"].value = "bar"
+
+        def query_func(arg):
+            return Query(arg).select_function("foo").modify(modifier)
+
+        self.run_bowler_modifiers(
+            [("def foo(): pass", "def bar(): pass")], query_func=query_func
+        )
+
+    def test_is_filename_include_and_exclude(self):
+        def query_func(arg):
+            return (
+                Query(arg)
+                .select_function("f")
+                .is_filename(include=r"\.py$", exclude="nothing")
+                .rename("g")
+            )
+
+        output = self.run_bowler_modifier("f()", query_func=query_func)
+        self.assertEqual("g()", output)
+
+    def test_hoist_filename_matchers(self):
+        query = Query().select_function("f").is_filename(exclude="skip/")
+        filename_matcher, directory_matcher = query.hoist_filename_matchers()
+        self.assertTrue(filename_matcher("src/a.py"))
+        self.assertFalse(filename_matcher("src/skip/a.py"))
+        self.assertTrue(directory_matcher("src/"))
+        self.assertFalse(directory_matcher("src/skip/"))
+
+        # anchored patterns can't prune directories
+        query = Query().select_function("f").is_filename(exclude=r"skip/a\.py$")
+        filename_matcher, directory_matcher = query.hoist_filename_matchers()
+        self.assertFalse(filename_matcher("src/skip/a.py"))
+        self.assertIsNone(directory_matcher)
+
+        # a transform without filename filters needs to see every file
+        query.select_function("g")
+        self.assertEqual(query.hoist_filename_matchers(), (None, None))
+
+    def test_is_filename_skips_discovery(self):
+        with volatile.dir() as tmp:
+            for name in ("a.py", "a_test.py", "skip/b.py", "keep/c.py"):
+                path = os.path.join(tmp, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    f.write("f()\n")
+
+            queued = []
+            with mock.patch.object(
+                BowlerTool, "queue_work", lambda tool, filename: queued.append(filename)
+            ), mock.patch.object(BowlerTool, "log_debug") as log_debug:
+                (
+                    Query(tmp)
+                    .select_function("f")
+                    .is_filename(exclude="skip/|_test")
+                    .rename("g")
+                    .silent(in_process=True)
+                )
+
+            self.assertEqual(
+                sorted(os.path.relpath(f, tmp) for f in queued), ["a.py", "keep/c.py"]
+            )
+            walked = [
+                os.path.relpath(c[0][1], tmp)
+                for c in log_debug.call_args_list
+                if c[0][0] == "Descending into %s"
+            ]
+            self.assertEqual(walked, [".", "keep"])
@@ -7,6 +7,7 @@
 
 import io
 import logging
+import os
 import subprocess
 import sys
 from pathlib import Path
@@ -17,6 +18,7 @@ from fissix.fixer_util import Call, Name
 
 from ..query import Query
 from ..types import TOKEN, BadTransform
+from .lib import isolate_caches
 
 STDERR = io.StringIO()
 
@@ -26,6 +28,9 @@ class SmokeTest(TestCase):
     def setUpClass(cls):
         logging.basicConfig(stream=STDERR)
 
+    def setUp(self):
+        isolate_caches(self)
+
     def test_tr(self):
         target = Path(__file__).parent / "smoke-target.py"
 
@@ -91,6 +96,7 @@ class SmokeTest(TestCase):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             encoding="utf-8",
+            env=dict(os.environ, BOWLER_NO_PATTERN_CACHE="1"),
         )
         self.assertIn("Ran 2 tests", proc.stderr)
         self.assertEqual(1, proc.returncode)
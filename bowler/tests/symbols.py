@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from fissix.pytree import Leaf
+
+from ..symbols import SymbolTable, selected_name
+from ..types import TOKEN
+from .lib import BowlerTestCase
+
+SOURCE = """\
+import os.path as osp, sys
+from . import x as y
+from m import (a)
+g = 1
+
+class C(Base):
+    attr = g
+
+    def m(self, p, q: int = g, *r, **s):
+        global g
+        g = p
+        t = [i for i in r if i for j in s]
+        u = lambda v, w=attr: v + w
+        with open(p) as (f, h):
+            pass
+        try:
+            pass
+        except E as e:
+            pass
+        for k, (l, *n) in s:
+            pass
+        (o := len(t))
+
+        def inner():
+            nonlocal t
+            t = 2
+
+        return attr
+"""
+
+
+class SymbolTableTest(BowlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tree = self.parse_source(SOURCE)
+        self.table = SymbolTable.of(self.tree)
+        self.leaves = {}
+        for leaf in self.tree.leaves():
+            self.leaves.setdefault(leaf.value, []).append(leaf)
+
+    def bound(self, scope):
+        return {
+            name: [b.kind for b in bindings]
+            for name, bindings in scope.bindings.items()
+        }
+
+    def test_scopes(self):
+        table = self.table
+        self.assertIs(SymbolTable.of(self.leaves["attr"][0]), table)
+        self.assertEqual(
+            [scope.kind for scope in table.scopes],
+            ["module", "class", "function", "comprehension", "lambda", "function"],
+        )
+        module, cls, method, comprehension, lambda_, inner = table.scopes
+        self.assertEqual(
+            self.bound(module),
+            {
+                "osp": ["import"],
+                "sys": ["import"],
+                "y": ["import"],
+                "a": ["import"],
+                "g": ["assign", "assign"],
+                "C": ["class"],
+            },
+        )
+        self.assertEqual(self.bound(cls), {"attr": ["assign"], "m": ["def"]})
+        self.assertEqual(
+            self.bound(method),
+            {
+                "self": ["param"],
+                "p": ["param"],
+                "q": ["param"],
+                "r": ["param"],
+                "s": ["param"],
+                "t": ["assign", "assign"],
+                "u": ["assign"],
+                "f": ["with"],
+                "h": ["with"],
+                "e": ["except"],
+                "k": ["for"],
+                "l": ["for"],
+                "n": ["for"],
+                "o": ["assign"],
+                "inner": ["def"],
+            },
+        )
+        self.assertEqual(self.bound(comprehension), {"i": ["for"], "j": ["for"]})
+        self.assertEqual(self.bound(lambda_), {"v": ["param"], "w": ["param"]})
+        self.assertEqual(self.bound(inner), {})
+        self.assertEqual(method.globals, {"g"})
+        self.assertEqual(inner.nonlocals, {"t"})
+        self.assertIs(inner.function, inner)
+        self.assertIs(comprehension.function, method)
+        self.assertIsNone(cls.function)
+
+    def test_imports(self):
+        bindings = self.table.module.bindings
+        self.assertEqual(bindings["osp"][0].module, "os.path")
+        self.assertEqual(bindings["sys"][0].module, "sys")
+        self.assertEqual(
+            (bindings["y"][0].module, bindings["y"][0].imported), (".", "x")
+        )
+        self.assertEqual(
+            (bindings["a"][0].module, bindings["a"][0].imported), ("m", "a")
+        )
+
+    def test_lookup(self):
+        module, cls, method, comprehension, lambda_, inner = self.table.scopes
+
+        def lookups(name):
+            return [self.table.lookup(leaf) for leaf in self.leaves[name]]
+
+        # class bodies are skipped from nested scopes
+        self.assertEqual(lookups("attr"), [cls, None, None])
+        self.assertEqual(lookups("g"), [module] * 5)
+        self.assertEqual(lookups("i"), [comprehension] * 3)
+        # the first iterable belongs to the enclosing scope
+        self.assertEqual(lookups("r"), [method, method])
+        self.assertEqual(lookups("w"), [lambda_, lambda_])
+        self.assertEqual(lookups("t"), [method] * 4)
+        self.assertEqual(lookups("len"), [None])
+        self.assertIsNone(self.table.lookup(self.leaves["("][0]))
+
+        # definitions belong to the enclosing scope
+        self.assertIs(self.table.scope(self.leaves["m"][1].parent), cls)
+        self.assertEqual(self.table.bindings(self.leaves["osp"][0])[0].kind, "import")
+        self.assertEqual(self.table.bindings(self.leaves["len"][0]), [])
+
+    def test_added_nodes(self):
+        leaf = self.leaves["t"][-1]
+        new = Leaf(TOKEN.NAME, "t")
+        leaf.replace(new)
+        self.assertIs(self.table.scope(new), self.table.scopes[-1])
+        self.assertIs(self.table.lookup(new), self.table.scopes[2])
+
+    def test_selected_name(self):
+        leaf = self.leaves["p"][-1]
+        self.assertIs(selected_name(leaf, {}), leaf)
+        self.assertIs(
+            selected_name(leaf.parent, {"node": leaf.parent, "x_name": leaf}), leaf
+        )
+        imported = self.leaves["a"][0]
+        capture = {"module_name": self.leaves["m"][0], "function_name": imported}
+        self.assertIs(selected_name(imported.parent, capture), imported)
+        self.assertIs(
+            selected_name(imported.parent, capture, "function_name"), imported
+        )
+        self.assertIsNone(selected_name(imported.parent, capture, "class_name"))
+        attribute = self.parse_line("a.b").children[1].children[1]
+        self.assertIsNone(selected_name(attribute, {}))
+        self.assertIsNone(selected_name(self.parse_line("a.b"), {}))
@@ -5,13 +5,19 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import difflib
 import os
+import subprocess
+import sys
 from pathlib import Path
-from unittest import TestCase, mock
+from unittest import TestCase, mock, skipUnless
+
+import volatile
 
 from ..query import Query
-from ..tool import BadTransform, BowlerTool, log
-from ..types import BowlerQuit
+from ..tool import BadTransform, BowlerTool, diff_hunks, diff_texts, log, source_names
+from ..types import BowlerQuit, RetryFile
+from .lib import isolate_caches
 
 target = Path(__file__).parent / "smoke-target.py"
 hunks = [
@@ -50,6 +56,7 @@ hunks = [
 
 class ToolTest(TestCase):
     def setUp(self):
+        isolate_caches(self)
         echo_patcher = mock.patch("bowler.tool.click.echo")
         secho_patcher = mock.patch("bowler.tool.click.secho")
         self.addCleanup(echo_patcher.stop)
@@ -57,6 +64,62 @@ class ToolTest(TestCase):
         self.mock_echo = echo_patcher.start()
         self.mock_secho = secho_patcher.start()
 
+    def test_diff_texts(self):
+        def unified_diff(a, b):
+            return list(
+                difflib.unified_diff(
+                    a.splitlines(), b.splitlines(), "f", "f", lineterm=""
+                )
+            )
+
+        lines = [f"x{i} = foo({i})" for i in range(100)]
+        a = "\n".join(lines) + "\n"
+        for b in (
+            a,
+            a.replace("x50 = foo(50)", "x50 = bar(50)"),
+            a.replace("x1 = foo(1)", "x1 = bar(1)").replace("foo(98)", "bar(98)"),
+            a.replace("x5 = foo(5)\n", "").replace("x9 = foo(9)", "x9 = bar(9)"),
+            a.replace("x0 = foo(0)\n", "x0 = foo(0)\ny = 1\nz = 2\n"),
+            a.replace("x99 = foo(99)\n", ""),
+            "",
+        ):
+            self.assertEqual(list(diff_texts(a, b, "f")), unified_diff(a, b))
+
+    def test_diff_hunks(self):
+        a = "".join(f"x{i} = {i}\n" for i in range(20))
+        b = a.replace("x2 = 2", "x2 = 3").replace("x15 = 15", "x15 = 16")
+        hunks = diff_hunks(a, b, "f")
+        self.assertEqual(
+            hunks,
+            [
+                [
+                    "--- f",
+                    "+++ f",
+                    "@@ -1,6 +1,6 @@",
+                    " x0 = 0",
+                    " x1 = 1",
+                    "-x2 = 2",
+                    "+x2 = 3",
+                    " x3 = 3",
+                    " x4 = 4",
+                    " x5 = 5",
+                ],
+                [
+                    "--- f",
+                    "+++ f",
+                    "@@ -13,7 +13,7 @@",
+                    " x12 = 12",
+                    " x13 = 13",
+                    " x14 = 14",
+                    "-x15 = 15",
+                    "+x15 = 16",
+                    " x16 = 16",
+                    " x17 = 17",
+                    " x18 = 18",
+                ],
+            ],
+        )
+
     @mock.patch("bowler.tool.apply_single_file")
     def test_process_hunks_patch_called_correctly(self, mock_patch):
         tool = BowlerTool(Query().compile(), write=True, interactive=False, silent=True)
@@ -155,3 +218,304 @@ class ToolTest(TestCase):
         tool = BowlerTool(Query().compile(), silent=False)
         with self.assertRaises(BadTransform):
             tool.processed_file(new_text="x=1///2", filename="foo.py", old_text="x=1/2")
+
+    def test_refactor_tree_walks(self):
+        query = (
+            Query()
+            .select_function("f")
+            .rename("g")
+            .select_class("A")
+            .rename("B")
+            .select_var("x")
+            .rename("y")
+        )
+        tool = BowlerTool(query.compile(), options={"print_function": True})
+        tree = tool.driver.parse_string("class A:\n    def f(self):\n        x = 1\n")
+
+        with mock.patch.object(
+            BowlerTool, "walk_pre_order"
+        ) as walk_pre_order, mock.patch.object(
+            BowlerTool, "walk_post_order", wraps=tool.walk_post_order
+        ) as walk_post_order:
+            self.assertTrue(tool.refactor_tree(tree, "foo.py"))
+        walk_pre_order.assert_not_called()
+        walk_post_order.assert_called_once()
+        self.assertEqual(str(tree), "class B:\n    def g(self):\n        y = 1\n")
+
+    def test_refactor_tree_index(self):
+        calls = []
+        query = (
+            Query()
+            .select_function("f")
+            .filter(lambda node, capture, filename: calls.append(str(node)))
+            .select_class("A")
+            .rename("B")
+        )
+        tool = BowlerTool(query.compile(), options={"print_function": True})
+        source = "class A:\n    def f(self):\n        return f(A(), g())\nA()\n"
+        tree = tool.driver.parse_string(source)
+
+        with mock.patch.object(
+            BowlerTool, "walk_candidates", wraps=tool.walk_candidates
+        ) as walk_candidates, mock.patch.object(
+            BowlerTool, "apply_fixers", wraps=tool.apply_fixers
+        ) as apply_fixers:
+            tool.refactor_tree(tree, "foo.py")
+        walk_candidates.assert_called_once()
+        self.assertEqual(
+            calls, [" f(B(), g())", "def f(self):\n        return f(B(), g())\n"]
+        )
+        self.assertEqual(str(tree), source.replace("A", "B"))
+        # nodes before the first renamed class are skipped, then the walk
+        # continues from there up to the root
+        visited = [call[0][1] for call in apply_fixers.call_args_list]
+        self.assertLess(len(visited), len(list(tree.post_order())))
+        self.assertEqual(str(visited[0]), ",")
+        self.assertIs(visited[-1], tree)
+
+    def test_validate_python3(self):
+        tool = BowlerTool(Query().compile(), options={"print_function": True})
+        with mock.patch.object(tool.driver, "parse_string") as parse_string:
+            tool.validate("print('str')\n", "foo.py")
+            parse_string.assert_not_called()
+
+            # code CPython rejects still gets a second opinion from fissix
+            parse_string.return_value = None
+            with self.assertRaises(AssertionError):
+                tool.validate("print 'str'\n", "foo.py")
+            parse_string.assert_called_once()
+
+        with self.assertRaises(BadTransform):
+            tool.processed_file(
+                new_text="print 'str'\n", filename="foo.py", old_text="print('str')\n"
+            )
+
+    def test_source_names(self):
+        source = b"""\
+import os.path as p
+# foo
+s = "bar" + f"{baz}"
+def f(a, *b, c=1, **d):
+    global g
+    return a.attr(k=v)
+"""
+        self.assertEqual(
+            source_names(source),
+            {"os", "path", "p", "s", "baz", "f", "a", "b", "c", "d", "g"}
+            | {"attr", "k", "v"},
+        )
+        self.assertIsNone(source_names(b"print 'str'\n"))
+
+    def test_ast_prefilter(self):
+        files = {
+            "comment.py": "# foo()\n",
+            "string.py": "x = 'foo'\n",
+            "call.py": "foo()\n",
+            "python2.py": "print 'foo'\nfoo()\n",
+        }
+        with volatile.dir() as tmp:
+            for name, source in files.items():
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write(source)
+
+            fixers = Query().select_function("foo").compile()
+            for ast_prefilter, expected in (
+                (False, ["call.py", "comment.py", "python2.py", "string.py"]),
+                (True, ["call.py", "python2.py"]),
+            ):
+                tool = BowlerTool(fixers, ast_prefilter=ast_prefilter)
+                matches = [
+                    name
+                    for name in sorted(files)
+                    if tool.might_match(os.path.join(tmp, name))
+                ]
+                self.assertEqual(matches, expected)
+
+            # keywords are NAME tokens to fissix, but not names to CPython
+            fixers = Query().select("classdef< 'class' 'Foo' any* >").compile()
+            tool = BowlerTool(fixers, ast_prefilter=True)
+            with open(os.path.join(tmp, "call.py"), "w") as f:
+                f.write("class Foo: pass\n")
+            self.assertTrue(tool.might_match(os.path.join(tmp, "call.py")))
+
+    @skipUnless(BowlerTool.can_fork(), "requires fork")
+    def test_multiprocess(self):
+        tool = BowlerTool(Query().compile(), in_process=False)
+        self.assertFalse(tool.in_process)
+
+        with volatile.dir() as tmp:
+            for i in range(5):
+                with open(os.path.join(tmp, f"mod{i}.py"), "w") as f:
+                    f.write(f"def f():\n    return {i}\n")
+
+            processed = []
+            query = (
+                Query(tmp)
+                .select_function("f")
+                .rename("g")
+                .process(lambda filename, hunk: processed.append(filename))
+                .diff(in_process=False)
+            )
+            self.assertEqual(query.retcode, 0)
+            self.assertEqual(len(processed), 5)
+
+    @skipUnless(BowlerTool.can_fork(), "requires fork")
+    def test_multiprocess_child_exits(self):
+        def die(node, capture, filename):
+            os._exit(1)
+
+        with volatile.dir() as tmp:
+            with open(os.path.join(tmp, "mod.py"), "w") as f:
+                f.write("def f():\n    pass\n")
+
+            # a child dying mid-queue must not leave the parent waiting forever
+            query = Query(tmp).select_function("f").modify(die).diff(in_process=False)
+            self.assertEqual(query.retcode, 1)
+            self.assertEqual(len(query.exceptions), 1)
+            self.assertIn("exited with code 1", str(query.exceptions[0]))
+
+    def batching_tool(self, **kwargs):
+        tool = BowlerTool(Query().compile(), in_process=True, **kwargs)
+        tool.BATCH_BYTES = 100
+        # nothing consumes batches during these tests, so lift the bound
+        tool.queue = tool.context.JoinableQueue()
+        return tool
+
+    def drain(self, tool):
+        tool.queue.put(None)
+        batches = []
+        while True:
+            batch = tool.queue.get()
+            if batch is None:
+                return batches
+            batches.append(batch)
+
+    def test_queue_batches(self):
+        tool = self.batching_tool(batch_size=2)
+        for i, size in enumerate([10, 10, 10, 200, 10]):
+            tool.add_to_batch(f"{i}.py", size)
+        tool.flush_batch()
+
+        batches = self.drain(tool)
+        self.assertEqual(batches, [["0.py", "1.py"], ["2.py", "3.py"], ["4.py"]])
+        self.assertEqual(tool.batch, [])
+
+    def test_batch_size(self):
+        tool = BowlerTool(Query().compile(), in_process=True)
+        tool.queue_count = 10
+        self.assertEqual(tool.get_batch_size(4), 1)
+        tool.queue_count = 100_000
+        self.assertEqual(tool.get_batch_size(4), tool.MAX_BATCH_SIZE)
+        tool.queue_count = 800
+        self.assertEqual(tool.get_batch_size(4), 25)
+
+        tool = BowlerTool(Query().compile(), in_process=True, batch_size=3)
+        self.assertEqual(tool.get_batch_size(4), 3)
+
+    def test_queue_batches_by_size(self):
+        tool = self.batching_tool(batch_size=2, schedule="size")
+        tool.pending = [(f"{i}.py", size) for i, size in enumerate([10, 30, 200, 20])]
+        tool.queue_pending()
+        tool.flush_batch()
+
+        batches = self.drain(tool)
+        self.assertEqual(batches, [["2.py"], ["1.py", "3.py"], ["0.py"]])
+        self.assertEqual(tool.pending, [])
+
+    def test_streaming_bounded_queue(self):
+        with volatile.dir() as tmp:
+            for i in range(20):
+                with open(os.path.join(tmp, f"mod{i}.py"), "w") as f:
+                    f.write("def f():\n    pass\n")
+
+            processed = []
+            tool = BowlerTool(
+                Query().select_function("f").rename("g").compile(),
+                in_process=True,
+                silent=True,
+                batch_size=1,
+                hunk_processor=lambda filename, hunk: processed.append(filename),
+            )
+            # discovery has to wait for the worker to drain a one-slot queue
+            tool.queue = tool.context.JoinableQueue(1)
+            tool.refactor([tmp])
+            self.assertEqual(len(processed), 20)
+
+    def test_quit_exits(self):
+        # with 8 workers' worth of batches queued ahead, enough long filenames
+        # to fill the pipe behind the bounded queue, so that the queue's feeder
+        # thread is still blocked when the user quits
+        script = """\
+import os, sys
+from unittest import mock
+from bowler import BowlerTool, Query
+
+BowlerTool.NUM_PROCESSES = 8
+root = os.path.join(sys.argv[1], "d" * 200, "e" * 200)
+os.makedirs(root)
+for i in range(1500):
+    with open(os.path.join(root, f"mod{i}.py"), "w") as f:
+        f.write("def f():\\n    pass\\n")
+with mock.patch("bowler.tool.prompt_user", return_value="q"):
+    with mock.patch("bowler.tool.click"):
+        Query(root).select_function("f").rename("g").execute(
+            interactive=True, in_process=True, batch_size=64
+        )
+print("returned")
+"""
+        root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        env = dict(os.environ, PYTHONPATH=root, BOWLER_NO_PATTERN_CACHE="1")
+        with volatile.dir() as tmp:
+            try:
+                proc = subprocess.run(
+                    [sys.executable, "-c", script, tmp],
+                    stdout=subprocess.PIPE,
+                    env=env,
+                    timeout=60,
+                )
+            except subprocess.TimeoutExpired:
+                self.fail("process didn't exit after quitting")
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(proc.stdout.strip(), b"returned")
+
+    def test_retry_file(self):
+        with volatile.dir() as tmp:
+            for i in range(20):
+                with open(os.path.join(tmp, f"mod{i}.py"), "w") as f:
+                    f.write("def f():\n    pass\n")
+            with open(os.path.join(tmp, "stuck.py"), "w") as f:
+                f.write("def f():\n    pass\n")
+
+            processed = []
+            tool = BowlerTool(
+                Query().select_function("f").rename("g").compile(),
+                in_process=True,
+                silent=True,
+                batch_size=1,
+                hunk_processor=lambda filename, hunk: processed.append(filename),
+            )
+            # retries must not wait for room on a queue that only they drain
+            tool.queue = tool.context.JoinableQueue(1)
+            refactor_file = tool.refactor_file
+            attempts = []
+
+            def flaky(filename):
+                attempts.append(filename)
+                if filename.endswith("stuck.py") or attempts.count(filename) == 1:
+                    raise RetryFile(filename)
+                return refactor_file(filename)
+
+            tool.refactor_file = flaky
+            tool.refactor([tmp])
+            self.assertEqual(len(processed), 20)
+            self.assertEqual(len(tool.exceptions), 1)
+            self.assertIn("stuck.py", str(tool.exceptions[0]))
+
+    def test_unknown_schedule(self):
+        with self.assertRaises(ValueError):
+            BowlerTool(Query().compile(), schedule="random")
+
+    def test_fork_only_on_linux(self):
+        with mock.patch("bowler.tool.sys.platform", "darwin"):
+            self.assertFalse(BowlerTool.can_fork())
+            self.assertTrue(BowlerTool(Query().compile(), in_process=False).in_process)
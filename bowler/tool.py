@@ -5,23 +5,48 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import ast
 import difflib
+import keyword
 import logging
 import multiprocessing
 import os
 import sys
-import time
-from queue import Empty
-from typing import Any, Iterator, List, Optional, Sequence, Tuple
+import threading
+import warnings
+from collections import Counter
+from itertools import chain
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from queue import Empty, Full
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
 
 import click
 from fissix import pygram
+from fissix.btm_matcher import BottomMatcher
+from fissix.fixer_base import BaseFix
+from fissix.fixer_util import find_root
+from fissix.pgen2 import token
 from fissix.pgen2.parse import ParseError
+from fissix.pytree import Base, Node
 from fissix.refactor import RefactoringTool, _detect_future_features
 from moreorless.patch import PatchException, apply_single_file
 
-from .helpers import filename_endswith
+from .cache import NameIndex, ParseCache, ResultCache
+from .helpers import TreeIndex, filename_endswith
 from .types import (
+    LN,
     BadTransform,
     BowlerException,
     BowlerQuit,
@@ -30,6 +55,7 @@ from .types import (
     Fixers,
     Hunk,
     Processor,
+    Result,
     RetryFile,
 )
 
@@ -45,10 +71,139 @@ PROMPT_HELP = {
 log = logging.getLogger(__name__)
 
 
-def diff_texts(a: str, b: str, filename: str) -> Iterator[str]:
+Opcode = Tuple[str, int, int, int, int]
+
+
+def diff_opcodes(a: List[str], b: List[str]) -> List[Opcode]:
+    """Line opcodes in the format of SequenceMatcher.get_opcodes().
+
+    Only the region between the common prefix and suffix of `a` and `b` is
+    diffed, which keeps large files with small edits cheap.  When that region
+    has the same number of lines on both sides and most of them are still equal,
+    as with renames, lines are compared pairwise instead of with difflib.
+    """
+    prefix = 0
+    limit = min(len(a), len(b))
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    end_a = len(a) - suffix
+    end_b = len(b) - suffix
+
+    codes: List[Opcode] = []
+    if prefix:
+        codes.append(("equal", 0, prefix, 0, prefix))
+
+    same = [a[i] == b[i] for i in range(prefix, end_a)] if end_a == end_b else []
+    if same and same.count(False) * 2 <= len(same):
+        start = prefix
+        for i in range(prefix + 1, end_a + 1):
+            if i == end_a or same[i - prefix] != same[start - prefix]:
+                tag = "equal" if same[start - prefix] else "replace"
+                codes.append((tag, start, i, start, i))
+                start = i
+    elif prefix < end_a or prefix < end_b:
+        matcher = difflib.SequenceMatcher(None, a[prefix:end_a], b[prefix:end_b])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            codes.append((tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix))
+
+    if suffix:
+        codes.append(("equal", end_a, len(a), end_b, len(b)))
+    return codes
+
+
+def group_opcodes(codes: List[Opcode], context: int = 3) -> Iterator[List[Opcode]]:
+    """Split opcodes into hunks with up to `context` lines of context, like
+    SequenceMatcher.get_grouped_opcodes()."""
+    if codes and codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes and codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group: List[Opcode] = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            yield group
+            group = []
+            i1, j1 = i2 - context, j2 - context
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def format_range(start: int, stop: int) -> str:
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return f"{start + 1 if length else start},{length}"
+
+
+def diff_hunks(a: str, b: str, filename: str, context: int = 3) -> List[Hunk]:
+    """Unified diff of two texts, as a list of hunks that each start with the
+    `---`/`+++` file headers followed by the `@@` range line."""
     lines_a = a.splitlines()
     lines_b = b.splitlines()
-    return difflib.unified_diff(lines_a, lines_b, filename, filename, lineterm="")
+    hunks: List[Hunk] = []
+    for group in group_opcodes(diff_opcodes(lines_a, lines_b), context):
+        first, last = group[0], group[-1]
+        hunk = [
+            f"--- {filename}",
+            f"+++ {filename}",
+            f"@@ -{format_range(first[1], last[2])} "
+            f"+{format_range(first[3], last[4])} @@",
+        ]
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                hunk.extend(" " + line for line in lines_a[i1:i2])
+                continue
+            hunk.extend("-" + line for line in lines_a[i1:i2])
+            hunk.extend("+" + line for line in lines_b[j1:j2])
+        hunks.append(hunk)
+    return hunks
+
+
+def diff_texts(a: str, b: str, filename: str) -> Iterator[str]:
+    hunks = diff_hunks(a, b, filename)
+    if hunks:
+        yield from hunks[0][:2]
+    for hunk in hunks:
+        yield from hunk[2:]
+
+
+def source_names(data: bytes) -> Optional[Set[str]]:
+    """Identifiers used in a module's code, found by CPython's parser, or None if
+    it can't parse the source.
+
+    Names only mentioned in strings or comments are not included, and neither
+    are keywords, which fissix also treats as NAME tokens.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(data)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+
+    names: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant):
+            continue
+        for _, value in ast.iter_fields(node):
+            if isinstance(value, str):
+                names.update(value.split("."))  # dotted module names
+            elif isinstance(value, list):
+                names.update(v for v in value if isinstance(v, str))
+    return names
+
+
+def is_keyword(name: str) -> bool:
+    return keyword.iskeyword(name) or name in getattr(keyword, "softkwlist", ())
 
 
 def prompt_user(question: str, options: str, default: str = "") -> str:
@@ -79,9 +234,43 @@ def prompt_user(question: str, options: str, default: str = "") -> str:
             return default
 
 
+class BowlerBottomMatcher(BottomMatcher):
+    """BottomMatcher that reports each candidate node at most once per fixer.
+
+    The stock matcher reports a node again for every leaf path that reaches it,
+    so fixers would transform (and run callbacks on) the same node repeatedly.
+    It also climbs the tree from every leaf; when every path starts at a leaf,
+    only leaves the automaton can start from are climbed.
+    """
+
+    def run(self, leaves):
+        start = self.root.transition_table
+        if all(isinstance(key, str) or key < 256 for key in start):
+            leaves = [
+                leaf
+                for leaf in leaves
+                if (leaf.value if leaf.type == token.NAME else leaf.type) in start
+            ]
+        results = super().run(leaves)
+        for fixer, nodes in results.items():
+            seen = set()
+            unique = []
+            for node in nodes:
+                if id(node) not in seen:
+                    seen.add(id(node))
+                    unique.append(node)
+            results[fixer] = unique
+        return results
+
+
 class BowlerTool(RefactoringTool):
     NUM_PROCESSES = os.cpu_count() or 1
     IN_PROCESS = False  # set when run DEBUG mode from command line
+    START_METHOD = "fork"
+    MAX_BATCH_SIZE = 64  # most files sent to a worker in one queue item
+    BATCH_BYTES = 256 * 1024  # close a batch early once it holds this much source
+    SCHEDULES = ("name", "size")  # order files are handed to workers
+    QUEUE_BATCHES = 2  # batches queued ahead per worker while discovery runs
 
     def __init__(
         self,
@@ -93,30 +282,91 @@ class BowlerTool(RefactoringTool):
         in_process: Optional[bool] = None,
         hunk_processor: Processor = None,
         filename_matcher: Optional[FilenameMatcher] = None,
+        directory_matcher: Optional[FilenameMatcher] = None,
+        batch_size: Optional[int] = None,
+        schedule: str = "name",
+        parse_cache: Optional[ParseCache] = None,
+        result_cache: Optional[ResultCache] = None,
+        ast_prefilter: bool = False,
+        name_index: Optional[NameIndex] = None,
         **kwargs,
     ) -> None:
         options = kwargs.pop("options", {})
         super().__init__(fixers, *args, options=options, **kwargs)
-        self.queue_count = 0
-        self.queue = multiprocessing.JoinableQueue()  # type: ignore
-        self.results = multiprocessing.Queue()  # type: ignore
-        self.semaphore = multiprocessing.Semaphore(self.NUM_PROCESSES)
+        self.BM = BowlerBottomMatcher()
+        for fixer in chain(self.post_order, self.pre_order):
+            if fixer.BM_compatible:
+                self.BM.add_fixer(fixer)
+        self.head_types = {
+            fixer: {t for t, fs in self.bmi_post_order_heads.items() if fixer in fs}
+            for fixer in self.bmi_post_order
+        }
         self.interactive = interactive
         self.write = write
         self.silent = silent
+        self.parse_cache = parse_cache
+        self.result_cache = result_cache
+        self.ast_prefilter = ast_prefilter
+        self.name_index = name_index
+        self.stats: Counter = Counter()
+        self.digests: Dict[Filename, str] = {}  # contents of files refactored
+        self.results: Dict[Filename, List[Hunk]] = {}  # hunks for those files
         if in_process is None:
             in_process = self.IN_PROCESS
-        # pick the most restrictive of flags; we can pickle fixers when
-        # using spawn.
-        if sys.platform == "win32" or sys.version_info > (3, 7):
+        # fixers are generated from closures and can't be pickled, so child
+        # processes must inherit them by forking.  CPython considers fork
+        # unsafe on macOS, so stay in process anywhere but Linux.
+        if not self.can_fork():
             in_process = True
         self.in_process = in_process
+        self.batch_size = batch_size
+        if schedule not in self.SCHEDULES:
+            raise ValueError(f"unknown schedule {schedule!r}")
+        self.schedule = schedule
+        self.pending: List[Tuple[Filename, int]] = []
+        self.batch: List[Filename] = []
+        self.batch_bytes = 0
+        self.workers = 1
+        self.stopping = threading.Event()
+        self.queue_count = 0
+        self.num_processes = self.NUM_PROCESSES
+        self.context = multiprocessing.get_context(
+            None if in_process else self.START_METHOD
+        )
+        self.queue = self.context.JoinableQueue(  # type: ignore
+            self.NUM_PROCESSES * self.QUEUE_BATCHES
+        )
+        self.semaphore = self.context.Semaphore(self.NUM_PROCESSES)
         self.exceptions: List[BowlerException] = []
         if hunk_processor is not None:
             self.hunk_processor = hunk_processor
         else:
             self.hunk_processor = lambda f, h: True
         self.filename_matcher = filename_matcher or filename_endswith(".py")
+        self.directory_matcher = directory_matcher
+        self.literals = self.get_literals()
+
+    @classmethod
+    def can_fork(cls) -> bool:
+        """Whether workers can be forked safely on this platform."""
+        return (
+            sys.platform.startswith("linux")
+            and cls.START_METHOD in multiprocessing.get_all_start_methods()
+        )
+
+    def get_literals(self) -> Optional[List[List[bytes]]]:
+        """Collect the `LITERALS` each fixer requires to be present in a file for
+        its pattern to match, or None if any fixer could match without them."""
+        literals: List[List[bytes]] = []
+        for fixer in self.fixers:
+            required = getattr(fixer, "LITERALS", None)
+            if not required:
+                return None
+            try:
+                literals.append([lit.encode("ascii") for lit in required])
+            except UnicodeEncodeError:
+                return None
+        return literals
 
     def log_error(self, msg: str, *args: Any, **kwds: Any) -> None:
         self.logger.error(msg, *args, **kwds)
@@ -133,40 +383,92 @@ class BowlerTool(RefactoringTool):
         self.files.append(filename)
         hunks: List[Hunk] = []
         if old_text != new_text:
-            a, b, *lines = list(diff_texts(old_text, new_text, filename))
-
-            hunk: Hunk = []
-            for line in lines:
-                if line.startswith("@@"):
-                    if hunk:
-                        hunks.append([a, b, *hunk])
-                        hunk = []
-                hunk.append(line)
-
-            if hunk:
-                hunks.append([a, b, *hunk])
-
-            original_grammar = self.driver.grammar
-            if "print_function" in _detect_future_features(new_text):
-                self.driver.grammar = pygram.python_grammar_no_print_statement
+            hunks = diff_hunks(old_text, new_text, filename)
             try:
-                new_tree = self.driver.parse_string(new_text)
-                if new_tree is None:
-                    raise AssertionError("Re-parsed CST is None")
+                self.validate(new_text, filename)
             except Exception as e:
                 raise BadTransform(
                     f"Transforms generated invalid CST for {filename}",
                     filename=filename,
                     hunks=hunks,
                 ) from e
-            finally:
-                self.driver.grammar = original_grammar
 
         return hunks
 
+    def validate(self, text: str, filename: str) -> None:
+        """Raise an exception if `text` is not valid source code.
+
+        Python 3 code is checked with CPython's own parser, which is much faster
+        than re-parsing with fissix.  Code it rejects, like Python 2 syntax or
+        syntax newer than the running interpreter, is re-parsed with fissix.
+        """
+        features = _detect_future_features(text)
+        if self.options["print_function"] or "print_function" in features:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    compile(text, filename, "exec", ast.PyCF_ONLY_AST, True)
+                return
+            except (SyntaxError, ValueError, RecursionError, MemoryError):
+                self.log_debug(f"{filename}: falling back to fissix for validation")
+
+        original_grammar = self.driver.grammar
+        if "print_function" in features:
+            self.driver.grammar = pygram.python_grammar_no_print_statement
+        try:
+            if self.driver.parse_string(text) is None:
+                raise AssertionError("Re-parsed CST is None")
+        finally:
+            self.driver.grammar = original_grammar
+
+    def might_match(self, filename: str) -> bool:
+        """Scan the raw file for the literal names that selectors require, so
+        that files which can't match any fixer skip parsing altogether.
+
+        With `ast_prefilter`, files that pass the scan are also parsed with
+        CPython's much faster parser, and skipped unless the names are used in
+        code, rather than only in strings or comments.  Files it can't parse
+        are refactored as usual.
+        """
+        if self.literals is None:
+            return True
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            return True  # let the regular read report the error
+        if not any(all(lit in data for lit in literals) for literals in self.literals):
+            return False
+        if not self.ast_prefilter:
+            return True
+
+        names = source_names(data)
+        if names is None:
+            return True
+        return any(
+            all(is_keyword(lit.decode()) or lit.decode() in names for lit in literals)
+            for literals in self.literals
+        )
+
     def refactor_file(self, filename: str, *a, **k) -> List[Hunk]:
+        digest = None
+        if self.result_cache is not None:
+            digest = self.result_cache.digest(Filename(filename))
+            cached = self.result_cache.get(Filename(filename), digest)
+            if cached is not None:
+                self.log_debug(f"Replaying {filename}: unchanged since last run")
+                self.stats["result_cache_hits"] += 1
+                self.digests[Filename(filename)] = cast(str, digest)
+                return cached
+            self.stats["result_cache_misses"] += 1
+
         try:
             hunks: List[Hunk] = []
+            if not self.might_match(filename):
+                self.log_debug(f"Skipping {filename}: no required literals found")
+                if digest is not None:
+                    self.digests[Filename(filename)] = digest
+                return hunks
             input, encoding = self._read_python_source(filename)
             if input is None:
                 # Reading the file failed.
@@ -180,7 +482,11 @@ class BowlerTool(RefactoringTool):
                 input += "\n"
             tree = self.refactor_string(input, filename)
             if tree:
-                hunks = self.processed_file(str(tree), filename, input)
+                # untouched trees still match the input, so skip rebuilding them
+                new_text = str(tree) if tree.was_changed else input
+                hunks = self.processed_file(new_text, filename, input)
+                if digest is not None:
+                    self.digests[Filename(filename)] = digest
         except ParseError as e:
             log.exception("Skipping {filename}: failed to parse ({e})")
 
@@ -192,9 +498,13 @@ class BowlerTool(RefactoringTool):
         Python files are those for which `self.filename_matcher(filename)`
         returns true, to allow for custom extensions.
 
-        Files and subdirectories starting with '.' are skipped.
+        Files and subdirectories starting with '.' are skipped, as are
+        subdirectories for which `self.directory_matcher(dirname + os.sep)`
+        returns false.
         """
         for dirpath, dirnames, filenames in os.walk(dir_name):
+            if self.stopping.is_set():
+                return
             self.log_debug("Descending into %s", dirpath)
             dirnames.sort()
             filenames.sort()
@@ -205,101 +515,288 @@ class BowlerTool(RefactoringTool):
                 ):
                     self.queue_work(Filename(fullname))
             # Modify dirnames in-place to remove subdirs with leading dots
-            dirnames[:] = [dn for dn in dirnames if not dn.startswith(".")]
+            dirnames[:] = [
+                dn
+                for dn in dirnames
+                if not dn.startswith(".")
+                and (
+                    self.directory_matcher is None
+                    or self.directory_matcher(Filename(os.path.join(dirpath, dn, "")))
+                )
+            ]
 
-    def refactor_queue(self) -> None:
+    def refactor_queue(self, send: Callable[[List[Result]], None]) -> None:
+        """Refactor queued batches of files until a None sentinel, passing the
+        results of each batch to `send` as soon as the batch is done.
+
+        Files that raise `RetryFile` are retried by the same worker once the
+        queue is drained, rather than put back on the bounded queue, which this
+        worker might be the only consumer of.
+        """
         self.semaphore.acquire()
-        while True:
-            filename = self.queue.get()
+        try:
+            retry: List[Filename] = []
+            while True:
+                batch = self.queue.get()
+                try:
+                    if batch is None:
+                        break
+                    results = self.refactor_batch(batch, retry)
+                    if results:
+                        send(results)
+                finally:
+                    self.queue.task_done()
 
-            if filename is None:
-                break
+            while retry:
+                batch, retry = retry, []
+                results = self.refactor_batch(batch, retry)
+                if len(retry) == len(batch):
+                    # no progress: stop retrying rather than looping forever
+                    results.extend(
+                        (
+                            filename,
+                            [],
+                            BowlerException(f"gave up retrying {filename}"),
+                        )
+                        for filename in retry
+                    )
+                    retry = []
+                if results:
+                    send(results)
+        finally:
+            self.semaphore.release()
 
+    def refactor_batch(
+        self, batch: List[Filename], retry: List[Filename]
+    ) -> List[Result]:
+        """Refactor a batch of files, adding files to retry later to `retry`."""
+        results: List[Result] = []
+        for filename in batch:
             try:
                 hunks = self.refactor_file(filename)
-                self.results.put((filename, hunks, None))
+                results.append((filename, hunks, None))
 
             except RetryFile:
                 self.log_debug(f"Retrying {filename} later...")
-                self.queue.put(filename)
+                retry.append(filename)
             except BowlerException as e:
                 log.exception(f"Bowler exception during transform of {filename}: {e}")
-                self.results.put((filename, e.hunks, e))
+                results.append((filename, e.hunks or [], e))
             except Exception as e:
                 log.exception(f"Skipping {filename}: failed to transform because {e}")
-                self.results.put((filename, [], e))
+                results.append((filename, [], e))
+        return results
 
-            finally:
-                self.queue.task_done()
-        self.semaphore.release()
+    def refactor_child(self, conn: Connection) -> None:
+        """Entry point for child processes: send results from the queue over
+        `conn`, followed by this child's stats and file digests."""
+        self.refactor_queue(conn.send)
+        conn.send((self.stats, self.digests))
+
+    def put_work(self, item: Optional[List[Filename]]) -> None:
+        """Put a batch (or sentinel) on the bounded work queue, waiting for room
+        unless the run is being stopped."""
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
 
     def queue_work(self, filename: Filename) -> None:
-        self.queue.put(filename)
+        """Add a file to the current batch, queueing the batch once it is full.
+
+        With the "size" schedule, files are held back until discovery finishes
+        so that they can be queued largest first.  With a `name_index`, files
+        that don't contain the names the fixers require are never queued.
+        """
+        if self.name_index is not None and self.literals is not None:
+            literals = [[lit.decode() for lit in lits] for lits in self.literals]
+            if not self.name_index.might_contain(filename, literals):
+                self.log_debug(f"Skipping {filename}: required names not indexed")
+                self.stats["name_index_skips"] += 1
+                return
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = 0
         self.queue_count += 1
+        if self.schedule == "size":
+            self.pending.append((filename, size))
+        else:
+            self.add_to_batch(filename, size)
+
+    def add_to_batch(self, filename: Filename, size: int) -> None:
+        """Batches hold up to `get_batch_size()` files, and are closed early once
+        they hold `BATCH_BYTES` of source."""
+        self.batch.append(filename)
+        self.batch_bytes += size
+        if (
+            len(self.batch) >= self.get_batch_size(self.workers)
+            or self.batch_bytes >= self.BATCH_BYTES
+        ):
+            self.flush_batch()
+
+    def flush_batch(self) -> None:
+        if self.batch:
+            self.put_work(self.batch)
+            self.batch = []
+            self.batch_bytes = 0
+
+    def queue_pending(self) -> None:
+        """Queue the files held back by the "size" schedule, largest first, so a
+        big module picked up last can't leave the other workers idle."""
+        pending, self.pending = self.pending, []
+        pending.sort(key=lambda item: item[1], reverse=True)
+        for filename, size in pending:
+            self.add_to_batch(filename, size)
+
+    def queue_paths(self, items: Sequence[str]) -> None:
+        """Walk the given files and directories, queueing batches as they fill,
+        and finish with one sentinel per worker.  Runs in a thread alongside the
+        workers, so that refactoring starts while discovery is still going."""
+        try:
+            for dir_or_file in sorted(items):
+                if self.stopping.is_set():
+                    break
+                if os.path.isdir(dir_or_file):
+                    self.refactor_dir(dir_or_file)
+                else:
+                    self.queue_work(Filename(dir_or_file))
+            self.queue_pending()
+            self.flush_batch()
+        except Exception as e:
+            log.exception(f"Failed to queue files: {e}")
+            error = BowlerException(f"failed to queue files: {e}")
+            error.__cause__ = e
+            self.exceptions.append(error)
+        finally:
+            for _ in range(self.workers):
+                self.put_work(None)
+
+    def get_batch_size(self, workers: int) -> int:
+        """Pick a batch size that amortizes IPC without starving workers: about
+        eight batches per worker for the files found so far, never more than
+        `MAX_BATCH_SIZE` files.  Batches start small while discovery streams in,
+        which gets the first results back quickly."""
+        if self.batch_size is not None:
+            return max(1, self.batch_size)
+        return max(1, min(self.MAX_BATCH_SIZE, self.queue_count // (workers * 8)))
+
+    def process_results(self, results: List[Result]) -> None:
+        for result in results:
+            self.process_result(result)
+
+    def process_result(self, result: Result) -> None:
+        filename, hunks, exc = result
+        if exc:
+            self.log_error(f"{type(exc).__name__}: {exc}")
+            if exc.__cause__:
+                self.log_error(f"  {type(exc.__cause__).__name__}: {exc.__cause__}")
+            if isinstance(exc, BowlerException) and exc.hunks:
+                diff = "\n".join("\n".join(hunk) for hunk in exc.hunks)
+                self.log_error(f"Generated transform:\n{diff}")
+            self.exceptions.append(exc)
+        else:
+            self.log_debug(f"results: got {len(hunks)} hunks for {filename}")
+            if self.result_cache is not None:
+                self.results[filename] = hunks
+            self.process_hunks(filename, hunks)
 
     def refactor(self, items: Sequence[str], *a, **k) -> None:
         """Refactor a list of files and directories."""
 
-        for dir_or_file in sorted(items):
-            if os.path.isdir(dir_or_file):
-                self.refactor_dir(dir_or_file)
-            else:
-                self.queue_work(Filename(dir_or_file))
-
-        children: List[multiprocessing.Process] = []
         if self.in_process:
-            self.queue.put(None)
-            self.refactor_queue()
+            self.workers = 1
+        elif any(os.path.isdir(item) for item in items):
+            self.workers = self.num_processes
         else:
-            child_count = max(1, min(self.NUM_PROCESSES, self.queue_count))
-            self.log_debug(f"starting {child_count} processes")
-            for i in range(child_count):
-                child = multiprocessing.Process(target=self.refactor_queue)
-                child.start()
-                children.append(child)
-                self.queue.put(None)
+            self.workers = max(1, min(self.num_processes, len(items)))
 
-        results_count = 0
+        producer = threading.Thread(target=self.queue_paths, args=(items,))
+        producer.daemon = True
 
-        while True:
+        if self.in_process:
+            producer.start()
             try:
-                filename, hunks, exc = self.results.get_nowait()
-                results_count += 1
-
-                if exc:
-                    self.log_error(f"{type(exc).__name__}: {exc}")
-                    if exc.__cause__:
-                        self.log_error(
-                            f"  {type(exc.__cause__).__name__}: {exc.__cause__}"
-                        )
-                    if isinstance(exc, BowlerException) and exc.hunks:
-                        diff = "\n".join("\n".join(hunk) for hunk in exc.hunks)
-                        self.log_error(f"Generated transform:\n{diff}")
-                    self.exceptions.append(exc)
-                else:
-                    self.log_debug(f"results: got {len(hunks)} hunks for {filename}")
-                    self.process_hunks(filename, hunks)
+                self.refactor_queue(self.process_results)
+            except BowlerQuit:
+                self.stop()
+            producer.join()
+            return
 
-            except Empty:
-                if self.queue.empty() and results_count == self.queue_count:
-                    break
+        # Each child sends results over its own pipe; the parent holds no
+        # copy of the write ends, so a pipe reaches EOF exactly when its child
+        # exits, whether it finished the queue or died along the way.
+        children: List[BaseProcess] = []
+        readers: List[Connection] = []
+        self.log_debug(f"starting {self.workers} processes")
+        for i in range(self.workers):
+            reader, writer = self.context.Pipe(duplex=False)
+            child = self.context.Process(  # type: ignore
+                target=self.refactor_child, args=(writer,)
+            )
+            child.start()
+            writer.close()
+            children.append(child)
+            readers.append(reader)
 
-                elif not self.in_process and not any(
-                    child.is_alive() for child in children
-                ):
-                    self.log_debug(f"child processes stopped without consuming work")
-                    break
+        # only start discovery once all children are forked
+        producer.start()
 
-                else:
-                    time.sleep(0.05)
+        quit = False
+        try:
+            while readers:
+                for reader in cast(List[Connection], wait(readers)):
+                    try:
+                        message = reader.recv()
+                    except EOFError:
+                        readers.remove(reader)
+                        continue
+                    if isinstance(message, tuple):
+                        stats, digests = message
+                        self.stats.update(stats)
+                        self.digests.update(digests)
+                    else:
+                        self.process_results(message)
 
-            except BowlerQuit:
-                for child in children:
-                    child.terminate()
-                break
+        except BowlerQuit:
+            quit = True
+            for child in children:
+                child.terminate()
+            self.stop()
+
+        for child in children:
+            child.join()
+            if child.exitcode and not quit:
+                # whatever the child was working on is lost
+                message = f"child process exited with code {child.exitcode}"
+                self.log_error(message)
+                self.exceptions.append(BowlerException(message))
+
+        if producer.is_alive():
+            # every child is gone, so nothing will drain the queue anymore
+            self.stop()
+        producer.join()
 
         self.log_debug(f"all children stopped and all diff hunks processed")
 
+    def stop(self) -> None:
+        """Stop discovery and discard any work still queued.
+
+        Batches the queue's feeder thread hasn't flushed yet would otherwise
+        keep the interpreter from exiting, since no worker is left to read them.
+        """
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except (Empty, OSError, ValueError):
+                break
+        self.queue.cancel_join_thread()
+
     def process_hunks(self, filename: Filename, hunks: List[Hunk]) -> None:
         auto_yes = False
         result = ""
@@ -364,9 +861,256 @@ class BowlerTool(RefactoringTool):
             with open(filename, "w") as f:
                 f.write(new_data)
 
+    def refactor_string(self, data: str, name: str) -> Optional[Node]:
+        """Parse and refactor a string, reusing a cached parse tree if possible.
+
+        Mirrors RefactoringTool.refactor_string(), but consults `parse_cache`
+        before tokenizing and parsing the source.
+        """
+        if self.parse_cache is None:
+            return super().refactor_string(data, name)
+
+        features = _detect_future_features(data)
+        if "print_function" in features:
+            grammar = pygram.python_grammar_no_print_statement
+        else:
+            grammar = self.grammar
+
+        key = self.parse_cache.key(data, grammar)
+        tree = self.parse_cache.get(key)
+        if tree is not None:
+            self.stats["parse_cache_hits"] += 1
+        else:
+            self.stats["parse_cache_misses"] += 1
+            self.driver.grammar = grammar
+            try:
+                tree = self.driver.parse_string(data)
+            except Exception as err:
+                self.log_error(
+                    "Can't parse %s: %s: %s", name, err.__class__.__name__, err
+                )
+                return None
+            finally:
+                self.driver.grammar = self.grammar
+            self.parse_cache.put(key, tree)
+
+        tree.future_features = features
+        self.log_debug("Refactoring %s", name)
+        self.refactor_tree(tree, name)
+        return tree
+
+    def refactor_tree(self, tree: Node, name: str) -> bool:
+        """Refactor a tree in place, mirroring RefactoringTool.refactor_tree().
+
+        RefactoringTool walks every tree twice, once for pre-order fixers and
+        once for post-order fixers, even when there are no fixers of that kind
+        (or none at all, when every fixer uses the bottom matcher), and walks
+        with recursive generators that get slower the deeper a node is.  Here,
+        only orders with fixers are walked, each with an explicit stack, so a
+        query's transforms normally share a single walk of the tree.
+        """
+        for fixer in chain(self.pre_order, self.post_order):
+            fixer.start_tree(tree, name)
+
+        if self.bmi_pre_order:
+            self.walk_pre_order(tree, self.bmi_pre_order_heads)
+        if self.bmi_post_order:
+            self.walk_post_order(tree, self.bmi_post_order_heads)
+        if self.BM.fixers:
+            self.bottom_match(tree)
+
+        for fixer in chain(self.pre_order, self.post_order):
+            fixer.finish_tree(tree, name)
+        return tree.was_changed
+
+    def apply_fixers(self, heads: Dict[int, List[BaseFix]], node: LN) -> None:
+        for fixer in heads.get(node.type, ()):
+            results = fixer.match(node)
+            if results:
+                new = fixer.transform(node, results)
+                if new is not None:
+                    node.replace(new)
+                    node = new
+
+    def walk_pre_order(self, tree: Node, heads: Dict[int, List[BaseFix]]) -> None:
+        # like Base.pre_order(), continue with the children of replaced nodes
+        stack = [iter([tree])]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                continue
+            self.apply_fixers(heads, node)
+            stack.append(iter(node.children))
+
+    def walk_post_order(self, tree: Node, heads: Dict[int, List[BaseFix]]) -> None:
+        if tree.was_changed:
+            stack = [(tree, iter(tree.children))]
+        else:
+            stack = self.walk_candidates(tree, heads)
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, iter(child.children)))
+                continue
+            stack.pop()
+            self.apply_fixers(heads, node)
+
+    def walk_candidates(
+        self, tree: Node, heads: Dict[int, List[BaseFix]]
+    ) -> List[Tuple[LN, Iterator[LN]]]:
+        """Apply post-order fixers using the tree's index, until the tree changes.
+
+        Only nodes of a fixer's head types are visited, and for fixers with
+        required `LITERALS`, only nodes containing one of them.  Once a
+        transform changes the tree, the index is stale, so this returns the
+        stack for walk_post_order() to continue from that node; otherwise it
+        returns an empty stack.
+        """
+        index = TreeIndex.of(tree)
+        candidates: Set[int] = set()
+        for fixer in self.bmi_post_order:
+            types = self.head_types[fixer]
+            literals = getattr(fixer, "LITERALS", None)
+            if literals:
+                literal = min(literals, key=lambda lit: len(index.names.get(lit, ())))
+                nodes = index.containing(literal, types)
+            else:
+                nodes = [node for t in types for node in index.types.get(t, ())]
+            candidates.update(map(id, nodes))
+
+        for node in index.post_order:
+            if id(node) not in candidates:
+                continue
+
+            path: Optional[List[Tuple[LN, int]]] = None
+            for fixer in heads.get(node.type, ()):
+                results = fixer.match(node)
+                if results:
+                    if path is None:
+                        path = self.walk_path(node)
+                    new = fixer.transform(node, results)
+                    if new is not None:
+                        node.replace(new)
+                        node = new
+
+            if path is not None and tree.was_changed:
+                stack = []
+                for ancestor, position in path:
+                    children = iter(ancestor.children)
+                    for _ in range(position + 1):
+                        next(children, None)
+                    stack.append((ancestor, children))
+                return stack
+
+        return []
+
+    @staticmethod
+    def walk_path(node: LN) -> List[Tuple[LN, int]]:
+        """Ancestors of `node` from the root down, each with the position of the
+        next node on the path among its children."""
+        path = []
+        while node.parent is not None:
+            parent = node.parent
+            path.append((parent, list(map(id, parent.children)).index(id(node))))
+            node = parent
+        path.reverse()
+        return path
+
+    def bottom_match(self, tree: Node) -> None:
+        """Apply bottom matcher fixers, as in RefactoringTool.refactor_tree()."""
+        match_set = self.BM.run(tree.leaves())
+
+        while any(match_set.values()):
+            for fixer in self.BM.fixers:
+                if not match_set.get(fixer):
+                    continue
+
+                # apply fixers from the bottom of the tree to the top
+                match_set[fixer].sort(key=Base.depth, reverse=True)
+                if fixer.keep_line_order:
+                    match_set[fixer].sort(key=Base.get_lineno)
+
+                for node in list(match_set[fixer]):
+                    if node in match_set[fixer]:
+                        match_set[fixer].remove(node)
+
+                    try:
+                        find_root(node)
+                    except ValueError:
+                        continue  # cut off by a previous transformation
+
+                    if node.fixers_applied and fixer in node.fixers_applied:
+                        continue
+
+                    results = fixer.match(node)
+                    if not results:
+                        continue
+
+                    new = fixer.transform(node, results)
+                    if new is not None:
+                        node.replace(new)
+                        # don't apply this fixer again to the new nodes
+                        for new_node in new.post_order():
+                            if not new_node.fixers_applied:
+                                new_node.fixers_applied = []
+                            new_node.fixers_applied.append(fixer)
+
+                        for fxr, nodes in self.BM.run(new.leaves()).items():
+                            match_set.setdefault(fxr, []).extend(nodes)
+
+    def summarize(self) -> None:
+        super().summarize()
+        if self.parse_cache is not None:
+            hits = self.stats["parse_cache_hits"]
+            misses = self.stats["parse_cache_misses"]
+            self.log_message(
+                "Parse cache: %d hits, %d misses (%.0f%% hit rate)",
+                hits,
+                misses,
+                100 * hits / max(1, hits + misses),
+            )
+        if self.result_cache is not None:
+            self.log_message(
+                "Incremental: %d files unchanged, %d refactored",
+                self.stats["result_cache_hits"],
+                self.stats["result_cache_misses"],
+            )
+        if self.name_index is not None and self.literals is not None:
+            self.log_message(
+                "Name index: %d files skipped", self.stats["name_index_skips"]
+            )
+        for index, fixer in enumerate(self.fixers):
+            plan = getattr(fixer, "PLAN", None)
+            if plan is not None and plan.evaluated:
+                label = f"{fixer.__name__} {index}"
+                selector = getattr(fixer, "SELECTOR", "")
+                if selector:
+                    label += f" (select_{selector})"
+                self.log_debug(f"Filters for {label}:")
+                for line in plan.report():
+                    self.log_debug(f"  {line}")
+
+    def save_results(self) -> None:
+        """Store hunks for every file that was refactored cleanly this run."""
+        records = {
+            filename: (self.digests[filename], hunks)
+            for filename, hunks in self.results.items()
+            if filename in self.digests
+        }
+        cast(ResultCache, self.result_cache).update(records)
+        cast(ResultCache, self.result_cache).save()
+
     def run(self, paths: Sequence[str]) -> int:
         if not self.errors:
             self.refactor(paths)
+            if self.parse_cache is not None:
+                self.parse_cache.evict()
+            if self.result_cache is not None:
+                self.save_results()
+            if self.name_index is not None:
+                self.name_index.save()
             self.summarize()
 
         return int(bool(self.errors or self.exceptions))
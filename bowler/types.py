@@ -5,7 +5,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Any, Callable, Dict, List, NewType, Optional, Type, Union
+from typing import Any, Callable, Dict, List, NewType, Optional, Tuple, Type, Union
 
 from attr import Factory, dataclass
 from fissix.fixer_base import BaseFix
@@ -49,6 +49,7 @@ Filter = Callable[[Node, Capture, Filename], bool]
 Fixers = List[Type[BaseFix]]
 Hunk = List[str]
 Processor = Callable[[Filename, Hunk], bool]
+Result = Tuple[Filename, List[Hunk], Any]
 
 
 @dataclass
@@ -58,6 +59,8 @@ class Transform:
     filters: List[Filter] = Factory(list)
     callbacks: List[Callback] = Factory(list)
     fixer: Optional[Type[BaseFix]] = None
+    filename_matchers: List[FilenameMatcher] = Factory(list)
+    directory_matchers: List[FilenameMatcher] = Factory(list)
 
 
 class BowlerException(Exception):
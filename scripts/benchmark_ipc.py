@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measure the per-file cost of shipping work to and results from child processes.
+
+Files are never parsed: refactor_file() is replaced with a no-op, so the time
+reported is dominated by queueing, pickling, and result collection.
+
+    python scripts/benchmark_ipc.py --files 20000 --batch-size 1
+"""
+
+import argparse
+import os
+import time
+from typing import List
+
+import volatile
+
+from bowler import Query
+from bowler.tool import BowlerTool
+from bowler.types import Hunk
+
+
+class NoopTool(BowlerTool):
+    def refactor_file(self, filename: str, *a, **k) -> List[Hunk]:
+        return []
+
+
+def run(path: str, batch_size: int) -> float:
+    tool = NoopTool(
+        Query().compile(),
+        interactive=False,
+        silent=True,
+        in_process=False,
+        batch_size=batch_size or None,
+    )
+    before = time.perf_counter()
+    tool.refactor([path])
+    return time.perf_counter() - before
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        action="append",
+        help="batch sizes to compare; 0 picks automatically (default: 1 and 0)",
+    )
+    args = parser.parse_args()
+
+    with volatile.dir() as tmp:
+        for i in range(args.files):
+            with open(os.path.join(tmp, f"mod{i}.py"), "w") as f:
+                f.write("x = 1\n")
+
+        for batch_size in args.batch_size or [1, 0]:
+            elapsed = run(tmp, batch_size)
+            label = batch_size or "auto"
+            per_file = elapsed / args.files * 1e6
+            print(f"batch size {label:>4}: {elapsed:6.2f}s, {per_file:7.1f}us per file")
+
+
+if __name__ == "__main__":
+    main()
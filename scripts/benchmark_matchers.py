@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare generated matchers against fissix's interpreted patterns.
+
+Every node of every file under the given paths (the standard library by default)
+is matched against each selector's pattern both ways; files are parsed once,
+up front, so only matching is timed.  Differing results are reported as errors.
+
+    python scripts/benchmark_matchers.py --name join /path/to/corpus
+"""
+
+import argparse
+import os
+import sysconfig
+import time
+from typing import Callable, List
+
+from fissix import pygram, pytree
+from fissix.pgen2.driver import Driver
+
+from bowler import Query
+from bowler.cache import PatternCache
+from bowler.types import LN
+
+
+def parse(paths: List[str], limit: int) -> List[LN]:
+    driver = Driver(pygram.python_grammar_no_print_statement, pytree.convert)
+    trees: List[LN] = []
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if not name.endswith(".py") or len(trees) >= limit:
+                    continue
+                try:
+                    with open(os.path.join(root, name)) as f:
+                        trees.append(driver.parse_string(f.read() + "\n"))
+                except Exception:
+                    continue
+    return trees
+
+
+def run(nodes: List[LN], match: Callable) -> float:
+    before = time.perf_counter()
+    for node in nodes:
+        match(node, {})
+    return time.perf_counter() - before
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="*", default=[sysconfig.get_paths()["stdlib"]])
+    parser.add_argument("--name", default="join", help="name to select")
+    parser.add_argument("--files", type=int, default=1000, help="max files to parse")
+    args = parser.parse_args()
+
+    trees = parse(args.paths, args.files)
+    nodes = [node for tree in trees for node in tree.pre_order()]
+    print(f"{len(trees)} files, {len(nodes)} nodes")
+
+    name = args.name
+    queries = {
+        "attribute": Query().select_attribute(name),
+        "class": Query().select_class(name),
+        "function": Query().select_function(name),
+        "method": Query().select_method(name),
+        "module": Query().select_module(name),
+        "subclass": Query().select_subclass(name),
+        "var": Query().select_var(name),
+    }
+    cache = PatternCache(None)
+    for selector, query in queries.items():
+        text = query.compile()[0].PATTERN
+        pattern, _ = cache.compile(text)
+        matcher = cache.matcher(text)
+
+        for node in nodes:
+            expected: dict = {}
+            results: dict = {}
+            if pattern.match(node, expected) != matcher(node, results) or (
+                expected != results
+            ):
+                print(f"error: {selector} matchers differ on {node!r}")
+                break
+
+        interpreted = run(nodes, pattern.match)
+        generated = run(nodes, matcher)
+        print(
+            f"{selector:>10}: interpreted {interpreted:6.2f}s, "
+            f"generated {generated:6.2f}s ({interpreted / generated:4.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()